@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Замер холодного старта: импорт bot.py, прогрев (post_init) и первый апдейт.
+
+Каждый прогон — новый процесс, как при рестарте на деплое.
+Telegram заменён заглушкой из simulate.py; GigaChat прогревается по-настоящему,
+только если задан GIGACHAT_AUTH.
+
+    python bench_startup.py --runs 5
+"""
+
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+def child():
+    """Один холодный старт; печатает замеры в JSON"""
+    import bot
+    imported = time.perf_counter()
+
+    from simulate import StubBot, make_update
+    from types import SimpleNamespace
+
+    bot.DATA_DIR = Path(tempfile.mkdtemp(prefix="stoyanka_bench_"))
+
+    async def run():
+        await bot.warm_up(None)
+        warmed = time.perf_counter()
+        stub_bot = StubBot([])
+        await bot.timed_handler(bot.cmd_status)(make_update(stub_bot, "/status"), SimpleNamespace(bot=stub_bot))
+        handled = time.perf_counter()
+        await bot.close_connections(None)
+        return warmed, handled
+
+    warmed, handled = asyncio.run(run())
+    if bot._process_pool:
+        bot._process_pool.shutdown()
+    print(json.dumps({
+        "import_ms": (imported - STARTED) * 1000,
+        "warm_up_ms": (warmed - imported) * 1000,
+        "first_update_ms": (handled - warmed) * 1000,
+        "total_ms": (handled - STARTED) * 1000
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер холодного старта бота")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    samples = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, __file__, "--child"],
+                             capture_output=True, text=True, check=True,
+                             cwd=Path(__file__).parent)
+        sample = json.loads(out.stdout.strip().splitlines()[-1])
+        sample["process_ms"] = (time.perf_counter() - started) * 1000
+        samples.append(sample)
+
+    print(f"Прогонов: {args.runs} (медиана / максимум, мс)")
+    for key in ("import_ms", "warm_up_ms", "first_update_ms", "total_ms", "process_ms"):
+        values = [s[key] for s in samples]
+        print(f"  {key:<16} {statistics.median(values):8.1f} / {max(values):8.1f}")
+
+if __name__ == "__main__":
+    main()
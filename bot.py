@@ -11,16 +11,28 @@ import os
 import json
 import random
 import logging
+import logging.handlers
+import queue
+import atexit
+import functools
 import asyncio
 import ssl
 import uuid
+import hashlib
+import heapq
+import fcntl
+import time
+import sys
+import io
 from datetime import datetime, timedelta
 from pathlib import Path
 from io import BytesIO
+from collections import deque, Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 import pytz
-import aiohttp
 from telegram import Update, InputMediaPhoto
+from telegram.error import RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     filters, ContextTypes, ConversationHandler
@@ -29,30 +41,78 @@ from telegram.ext import (
 # ============== КОНФИГУРАЦИЯ ==============
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 GIGACHAT_AUTH = os.environ.get("GIGACHAT_AUTH")  # Ключ из Сбера
+# Кому доступны /export и подобное (через запятую); пусто — зарегистрированному пользователю
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
 DATA_DIR = Path("/app/data")
+IMAGES_DIR = DATA_DIR / "images"  # Картинки орудий для недельного коллажа
+IMAGE_CACHE_DIR = DATA_DIR / "image_cache"  # Обработанные картинки GigaChat
 TIMEZONE = pytz.timezone("Europe/Moscow")
-
-BOT_START = datetime(2026, 1, 17, 16, 0, tzinfo=TIMEZONE)
-BOT_END = datetime(2026, 4, 11, 23, 59, tzinfo=TIMEZONE)
+CAMPAIGNS_FILE = Path(__file__).parent / "campaigns.json"  # Даты, цель, роли кампаний
 
 WAKEUP_HOUR = 5
 WAKEUP_MINUTE = 30
 REPORT_HOUR = 8  # Понедельник 8:00
 REPORT_MINUTE = 0
 
+# Событие, опоздавшее больше чем на столько (сек), пропускается
+MISFIRE_GRACE_SECONDS = 300
+
+# Лидер (процесс, который опрашивает Telegram и ведёт расписание) — один
+LEADER_LOCK_FILE = "leader.lock"
+LEADER_RETRY_SECONDS = 5
+
+# Снимок памяти процесса для тёплого рестарта
+RUNTIME_SNAPSHOT_FILE = "runtime_snapshot.json"
+RUNTIME_SNAPSHOT_INTERVAL = 300
+
 HUNGER_WARNING_HOURS = 12
 HUNGER_RIOT_HOURS = 24
 
 DOPAMINE_START_HOUR = 6
 DOPAMINE_END_HOUR = 22
+DOPAMINE_TIER_WEIGHTS = {"common": 70, "rare": 25, "legendary": 5}  # Шансы категорий, %
+DOPAMINE_RECENT_SIZE = 10  # Сколько последних наград не повторять
+DOPAMINE_SEED = os.environ.get("DOPAMINE_SEED")  # Фиксированный seed для воспроизводимости
 
 # GigaChat URLs
 GIGACHAT_OAUTH_URL = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
 GIGACHAT_API_URL = "https://gigachat.devices.sberbank.ru/api/v1"
+# Таймаут по умолчанию (токен, прогрев) и предел прогрева на старте (сек)
+GIGACHAT_TIMEOUT = 15
+GIGACHAT_WARM_UP_TIMEOUT = 5
 
 # Пауза между генерациями (сек)
 IMAGE_DELAY = 30
 
+# Не чаще одной правки сообщения в секунду при потоковом ответе
+STREAM_EDIT_INTERVAL = 1.0
+
+# Бюджет GigaChat (0 — без ограничения)
+GIGACHAT_BUDGET = {
+    "daily": {"images": int(os.environ.get("GIGACHAT_DAILY_IMAGES", 30)),
+              "tokens": int(os.environ.get("GIGACHAT_DAILY_TOKENS", 30000))},
+    "monthly": {"images": int(os.environ.get("GIGACHAT_MONTHLY_IMAGES", 600)),
+                "tokens": int(os.environ.get("GIGACHAT_MONTHLY_TOKENS", 600000))}
+}
+# С какой доли израсходованного бюджета включается каждая ступень экономии
+BUDGET_CACHED_IMAGES = 0.7   # картинки из кэша, если есть
+BUDGET_CACHED_TEXT = 0.85    # новых картинок нет, тексты Хранителя — из кэша
+BUDGET_TEXT_ONLY = 0.95      # только текст
+NARRATIVE_CACHE_SIZE = 20
+
+# Обработка картинок перед отправкой
+IMAGE_MAX_SIDE = 1280   # Telegram всё равно ужимает фото до 1280 px
+IMAGE_QUALITY = 82
+IMAGE_CACHE_PER_PROMPT = 5  # Сколько последних картинок хранить на промпт
+
+# Коллаж недели
+COLLAGE_TILE = 320      # Размер клетки (px)
+COLLAGE_COLUMNS = 4
+COLLAGE_CAPTION_HEIGHT = 44
+IMAGE_WORKERS = 2       # Процессы для обработки картинок
+ALBUM_LIMIT = 10        # Максимум фото в альбоме Telegram
+CAPTION_LIMIT = 1024    # Максимум символов в подписи к фото
+
 # Типы орудий и материалы
 TOOL_TYPES = {
     "arrowhead": "Наконечник стрелы",
@@ -71,12 +131,95 @@ MATERIALS = {
     "quartzite": "Кварцит"
 }
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+# ============== ЛОГИ ==============
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = 10000
+# Доля записей уровня, которая попадает в лог (частые события — DEBUG)
+LOG_SAMPLE_RATES = {logging.DEBUG: 0.05}
+LOG_FIELDS = ("user_id", "handler", "latency_ms", "status", "events", "images", "tokens", "budget_level", "dropped")
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка с полями из extra"""
+    
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for field in LOG_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей частых уровней"""
+    
+    def __init__(self):
+        super().__init__()
+        self.rng = random.Random()  # Свой генератор — не сбивает игровой random
+    
+    def filter(self, record):
+        rate = LOG_SAMPLE_RATES.get(record.levelno, 1.0)
+        return rate >= 1.0 or self.rng.random() < rate
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь без ожидания; при переполнении — выбрасывает"""
+    
+    dropped = 0
+    reported = 0  # сколько потерь уже попало в метрику
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def report_dropped(self):
+        """Метрика потерянных записей — одной строкой, только если появились новые"""
+        if self.dropped > self.reported:
+            logging.getLogger(__name__).warning("Log records dropped", extra={
+                "handler": "logging", "dropped": self.dropped - self.reported
+            })
+            self.reported = self.dropped
+
+def setup_logging():
+    """Запись логов — в фоновом потоке, event loop только кладёт в очередь"""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
+
+log_handler = setup_logging()
 logger = logging.getLogger(__name__)
 
+def timed_handler(func):
+    """Логирует пользователя, хендлер и время обработки апдейта"""
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        finally:
+            logger.info("update handled", extra={
+                "handler": func.__name__,
+                "user_id": update.effective_user.id if update.effective_user else None,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+            })
+    return wrapper
+
 # ============== ДОФАМИНОВЫЕ НАГРАДЫ (Мезолит) ==============
 DOPAMINE_REWARDS = {
     "common": [
@@ -167,110 +310,364 @@ DOPAMINE_REWARDS = {
     ]
 }
 
-def get_dopamine_reward():
-    """Возвращает кортеж: (современная, мезолитовая)"""
-    roll = random.randint(1, 100)
-    if roll <= 70:
-        category = "common"
-    elif roll <= 95:
-        category = "rare"
-    else:
-        category = "legendary"
+class AliasTable:
+    """Выборка по весам за O(1) — метод псевдонимов Уокера"""
+    
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            lo, hi = small.pop(), large.pop()
+            self.prob[lo] = scaled[lo]
+            self.alias[lo] = hi
+            scaled[hi] -= 1.0 - scaled[lo]
+            (small if scaled[hi] < 1.0 else large).append(hi)
+    
+    def sample(self, rng):
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+class RewardEngine:
+    """Дофаминовые награды: таблица псевдонимов строится один раз,
+    у каждого пользователя свой генератор и память последних наград"""
+    
+    MAX_REDRAWS = 8
+    
+    def __init__(self, rewards, tier_weights, recent_size, seed=None):
+        self.items = []
+        weights = []
+        for tier, tier_weight in tier_weights.items():
+            for reward in rewards[tier]:
+                self.items.append(reward)
+                weights.append(tier_weight / len(rewards[tier]))
+        self.table = AliasTable(weights)
+        self.recent_size = min(recent_size, len(self.items) - 1)
+        self.seed = seed
+        self.rngs = {}
+        self.recent = {}  # user_id -> deque индексов последних наград
+    
+    def rng_for(self, user_id):
+        if user_id not in self.rngs:
+            if self.seed is None:
+                self.seed = random.getrandbits(64)
+            self.rngs[user_id] = random.Random(f"{self.seed}:{user_id}")
+        return self.rngs[user_id]
     
-    modern, meso = random.choice(DOPAMINE_REWARDS[category])
+    def draw(self, user_id):
+        """(современная, мезолитовая) — без повтора последних recent_size наград"""
+        rng = self.rng_for(user_id)
+        recent = self.recent.setdefault(user_id, deque(maxlen=self.recent_size))
+        for _ in range(self.MAX_REDRAWS):
+            i = self.table.sample(rng)
+            if i not in recent:
+                break
+        recent.append(i)
+        return self.items[i]
+
+dopamine = RewardEngine(DOPAMINE_REWARDS, DOPAMINE_TIER_WEIGHTS, DOPAMINE_RECENT_SIZE, DOPAMINE_SEED)
+
+def get_dopamine_reward(user_id=None):
+    """Возвращает текст награды: современная + мезолитовая"""
+    modern, meso = dopamine.draw(user_id)
     return f"{modern}\n🏹 {meso}"
 
 # ============== GIGACHAT API ==============
 class GigaChatAPI:
     def __init__(self):
         self.token_cache = {"token": None, "expires": None}
+        self.session = None
+        self.ssl_context = None
+        self.timeouts = {}
+    
+    async def get_session(self):
+        """Общий пул соединений: TLS-рукопожатие один раз, дальше keep-alive"""
+        if self.session is None or self.session.closed:
+            import aiohttp  # Ленивый импорт: ~0.1 с на старте процесса
+            
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+            self.timeouts = {
+                "image": aiohttp.ClientTimeout(total=90),
+                "stream": aiohttp.ClientTimeout(total=60)
+            }
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=GIGACHAT_TIMEOUT))
+        return self.session
+    
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+    
+    async def warm_up(self):
+        """Токен и соединения с обоими хостами заранее, до первого апдейта"""
+        token = await self.get_token()
+        if not token:
+            return False
+        session = await self.get_session()
+        try:
+            async with session.get(
+                f"{GIGACHAT_API_URL}/models",
+                headers={"Authorization": f"Bearer {token}"},
+                ssl=self.ssl_context
+            ) as resp:
+                await resp.read()
+        except Exception as e:
+            logger.warning("GigaChat warm-up error: %s", e, extra={"handler": "warm_up"})
+        return True
     
     async def get_token(self):
         if self.token_cache["token"] and self.token_cache["expires"]:
-            if datetime.now().timestamp() < self.token_cache["expires"] - 60:
+            if now_msk().timestamp() < self.token_cache["expires"] - 60:
                 return self.token_cache["token"]
         
         if not GIGACHAT_AUTH:
             return None
         
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    GIGACHAT_OAUTH_URL,
-                    headers={
-                        "Content-Type": "application/x-www-form-urlencoded",
-                        "Accept": "application/json",
-                        "RqUID": str(uuid.uuid4()),
-                        "Authorization": f"Basic {GIGACHAT_AUTH}"
-                    },
-                    data="scope=GIGACHAT_API_PERS",
-                    ssl=ssl_context
-                ) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        self.token_cache["token"] = data["access_token"]
-                        self.token_cache["expires"] = data["expires_at"] / 1000
-                        return data["access_token"]
+            session = await self.get_session()
+            async with session.post(
+                GIGACHAT_OAUTH_URL,
+                headers={
+                    "Content-Type": "application/x-www-form-urlencoded",
+                    "Accept": "application/json",
+                    "RqUID": str(uuid.uuid4()),
+                    "Authorization": f"Basic {GIGACHAT_AUTH}"
+                },
+                data="scope=GIGACHAT_API_PERS",
+                ssl=self.ssl_context
+            ) as resp:
+                if resp.status == 200:
+                    data = await resp.json()
+                    self.token_cache["token"] = data["access_token"]
+                    self.token_cache["expires"] = data["expires_at"] / 1000
+                    return data["access_token"]
+                logger.error("GigaChat auth failed", extra={"handler": "get_token", "status": resp.status})
         except Exception as e:
-            logger.error(f"GigaChat auth error: {e}")
+            logger.error("GigaChat auth error: %s", e, extra={"handler": "get_token"})
         return None
     
-    async def generate_image(self, prompt):
+    async def generate_image(self, prompt, purpose="image", user_id=None):
         """Генерация через GigaChat-Max"""
         token = await self.get_token()
         if not token:
             return None
         
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
+        started = time.perf_counter()
         try:
-            timeout = aiohttp.ClientTimeout(total=90)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    f"{GIGACHAT_API_URL}/chat/completions",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Accept": "application/json",
-                        "Authorization": f"Bearer {token}"
-                    },
-                    json={
-                        "model": "GigaChat-Max",
-                        "messages": [{"role": "user", "content": prompt}],
-                        "function_call": "auto"
-                    },
-                    ssl=ssl_context
-                ) as resp:
-                    if resp.status != 200:
-                        return None
-                    data = await resp.json()
-                    content = data["choices"][0]["message"]["content"]
-                    
-                    if "<img src=\"" in content:
-                        start = content.find("<img src=\"") + 10
-                        end = content.find("\"", start)
-                        file_id = content[start:end]
-                        
-                        async with session.get(
-                            f"{GIGACHAT_API_URL}/files/{file_id}/content",
-                            headers={"Authorization": f"Bearer {token}"},
-                            ssl=ssl_context
-                        ) as img_resp:
-                            if img_resp.status == 200:
-                                return await img_resp.read()
+            session = await self.get_session()
+            async with session.post(
+                f"{GIGACHAT_API_URL}/chat/completions",
+                headers={
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                    "Authorization": f"Bearer {token}"
+                },
+                json={
+                    "model": "GigaChat-Max",
+                    "messages": [{"role": "user", "content": prompt}],
+                    "function_call": "auto"
+                },
+                ssl=self.ssl_context,
+                timeout=self.timeouts["image"]
+            ) as resp:
+                if resp.status != 200:
+                    # Неудачный вызов тоже учитываем: расход по нему неизвестен, но он был
+                    usage.record(purpose, user_id)
+                    logger.error("Image generation failed", extra={"handler": "generate_image", "status": resp.status})
+                    return None
+                data = await resp.json()
+                # Токены потрачены, даже если картинку потом не скачаем
+                usage.record(purpose, user_id, tokens=data.get("usage", {}).get("total_tokens", 0))
+                content = data["choices"][0]["message"]["content"]
+            
+            if "<img src=\"" in content:
+                start = content.find("<img src=\"") + 10
+                end = content.find("\"", start)
+                file_id = content[start:end]
+                
+                async with session.get(
+                    f"{GIGACHAT_API_URL}/files/{file_id}/content",
+                    headers={"Authorization": f"Bearer {token}"},
+                    ssl=self.ssl_context,
+                    timeout=self.timeouts["image"]
+                ) as img_resp:
+                    if img_resp.status == 200:
+                        raw = await img_resp.read()
+                        usage.record(purpose, user_id, images=1, calls=0)
+                        logger.info("Image generated", extra={
+                            "handler": "generate_image",
+                            "status": img_resp.status,
+                            "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+                        })
+                        return await postprocess_image(prompt, raw)
+                    logger.error("Image download failed", extra={"handler": "generate_image", "status": img_resp.status})
         except Exception as e:
-            logger.error(f"Image generation error: {e}")
+            logger.error("Image generation error: %s", e, extra={"handler": "generate_image"})
         return None
+    
+    async def stream_chat(self, prompt, temperature=0.8, purpose="chat", user_id=None):
+        """Потоковый ответ (stream: true, SSE): отдаёт кусочки текста по мере генерации"""
+        token = await self.get_token()
+        if not token:
+            return
+        
+        try:
+            session = await self.get_session()
+            async with session.post(
+                f"{GIGACHAT_API_URL}/chat/completions",
+                headers={
+                    "Content-Type": "application/json",
+                    "Accept": "text/event-stream",
+                    "Authorization": f"Bearer {token}"
+                },
+                json={
+                    "model": "GigaChat-Max",
+                    "messages": [{"role": "user", "content": prompt}],
+                    "temperature": temperature,
+                    "stream": True
+                },
+                ssl=self.ssl_context,
+                timeout=self.timeouts["stream"]
+            ) as resp:
+                if resp.status != 200:
+                    # Как и в generate_image: неудачный вызов тоже учитываем
+                    usage.record(purpose, user_id)
+                    logger.error("Stream chat failed", extra={"handler": "stream_chat", "status": resp.status})
+                    return
+                tokens = 0
+                text_length = len(prompt)
+                try:
+                    async for raw_line in resp.content:
+                        line = raw_line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            break
+                        chunk = json.loads(payload)
+                        tokens = chunk.get("usage", {}).get("total_tokens", tokens)
+                        delta = chunk["choices"][0].get("delta", {}).get("content")
+                        if delta:
+                            text_length += len(delta)
+                            yield delta
+                finally:
+                    # Если сервер не прислал usage — грубая оценка: ~3 символа на токен
+                    usage.record(purpose, user_id, tokens=tokens or text_length // 3)
+        except Exception as e:
+            logger.error("Stream chat error: %s", e, extra={"handler": "stream_chat"})
 
 gigachat = GigaChatAPI()
 
-async def generate_keeper_success_text(streak, is_elder):
-    """Генерирует вариативный текст успеха через GigaChat"""
+# ============== БЮДЖЕТ GIGACHAT ==============
+class UsageAccountant:
+    """Учёт картинок и токенов GigaChat по дням/месяцам, назначениям и пользователям"""
+    
+    FILE_NAME = "gigachat_usage.json"
+    
+    def __init__(self):
+        self.state = None
+    
+    def load(self):
+        if self.state is None:
+            try:
+                with open(DATA_DIR / self.FILE_NAME, "r", encoding="utf-8") as f:
+                    self.state = json.load(f)
+            except FileNotFoundError:
+                self.state = {}
+            except (OSError, ValueError) as e:
+                logger.error("Usage load error: %s", e)
+                self.state = {}
+        self.roll_over()
+        return self.state
+    
+    def roll_over(self):
+        """Новый день/месяц — новые счётчики (нарративы сохраняются)"""
+        day = now_msk().strftime("%Y-%m-%d")
+        if self.state.get("day") != day:
+            self.state["day"] = day
+            self.state["daily"] = {"calls": 0, "images": 0, "tokens": 0, "purposes": {}, "users": {}}
+        if self.state.get("month") != day[:7]:
+            self.state["month"] = day[:7]
+            self.state["monthly"] = {"calls": 0, "images": 0, "tokens": 0, "purposes": {}, "users": {}}
+        self.state.setdefault("narratives", {})
+    
+    def save(self):
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        file_path = DATA_DIR / self.FILE_NAME
+        tmp_path = file_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
+    
+    def record(self, purpose, user_id=None, images=0, tokens=0, calls=1):
+        state = self.load()
+        for period in ("daily", "monthly"):
+            totals = state[period]
+            for bucket in (totals, totals["purposes"].setdefault(purpose, {}),
+                           totals["users"].setdefault(str(user_id), {})):
+                bucket["calls"] = bucket.get("calls", 0) + calls
+                bucket["images"] = bucket.get("images", 0) + images
+                bucket["tokens"] = bucket.get("tokens", 0) + tokens
+        try:
+            self.save()
+        except OSError as e:
+            logger.error("Usage save error: %s", e)
+        logger.info("GigaChat usage", extra={
+            "handler": purpose, "user_id": user_id, "images": images,
+            "tokens": tokens, "budget_level": self.level()
+        })
+    
+    def spent_ratio(self):
+        """Наибольшая доля израсходованного бюджета по всем периодам и метрикам"""
+        state = self.load()
+        ratio = 0.0
+        for period, limits in GIGACHAT_BUDGET.items():
+            for metric, limit in limits.items():
+                if limit:
+                    ratio = max(ratio, state[period][metric] / limit)
+        return ratio
+    
+    def level(self):
+        """0 — всё можно, 1 — картинки из кэша, 2 — + тексты из кэша, 3 — только текст"""
+        ratio = self.spent_ratio()
+        if ratio >= BUDGET_TEXT_ONLY:
+            return 3
+        if ratio >= BUDGET_CACHED_TEXT:
+            return 2
+        if ratio >= BUDGET_CACHED_IMAGES:
+            return 1
+        return 0
+    
+    def remember_narrative(self, role, text):
+        narratives = self.load()["narratives"].setdefault(role, [])
+        narratives.append(text)
+        del narratives[:-NARRATIVE_CACHE_SIZE]
+        self.save()
+    
+    def cached_narrative(self, role):
+        narratives = self.load()["narratives"].get(role)
+        return random.choice(narratives) if narratives else None
+
+usage = UsageAccountant()
+
+async def get_image(prompt, purpose, user_id=None):
+    """Картинка с учётом бюджета: свежая → из кэша → никакой"""
+    level = usage.level()
+    if level >= 3:
+        return None
+    if level >= 1:
+        cached = get_cached_image(prompt)
+        if cached or level >= 2:
+            return cached
+    return await gigachat.generate_image(prompt, purpose=purpose, user_id=user_id)
+
+def get_keeper_prompt(streak, is_elder):
+    """Промпт для вариативного текста успеха Хранителя/Старшего"""
     
     # Сценарии для рандомизации (выбираем один)
     scenarios = [
@@ -302,38 +699,52 @@ async def generate_keeper_success_text(streak, is_elder):
                  f"что передал в знак мира (орехи, кусок мяса, место у костра), "
                  f"какой жест сделал. Стиль: земной, человеческий, без мистики.")
     
-    token = await gigachat.get_token()
-    if not token:
-        # Fallback если API не доступен
-        return "Слово сдержано. Порядок восстановлен."
+    return prompt
+
+async def stream_keeper_success(message, streak, is_elder, user_id=None):
+    """Показывает текст успеха по мере генерации, правя сообщение-заглушку"""
+    header = "✅ Зафиксировано.\n\n"
+    footer = f"\n🔥 Серия: {streak} дней"
+    role = "elder" if is_elder else "keeper"
+    level = usage.level()
     
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
+    if level >= 2:
+        # Бюджет на исходе: уже сгенерированный текст или запасной
+        text = (level == 2 and usage.cached_narrative(role)) or "Слово сдержано. Порядок восстановлен."
+    elif not await gigachat.get_token():
+        # Fallback если API не доступен
+        text = "Слово сдержано. Порядок восстановлен."
+    else:
+        loop = asyncio.get_running_loop()
+        text = ""
+        last_edit = 0.0
+        prompt = get_keeper_prompt(streak, is_elder)
+        async for chunk in gigachat.stream_chat(prompt, temperature=0.8, purpose="keeper", user_id=user_id):
+            text += chunk
+            if loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+                last_edit = loop.time()
+                await edit_quietly(message, f"{header}{text} …")
+        if text.strip():
+            usage.remember_narrative(role, text)
+        else:
+            text = "Договоренность удержана. Племя спокойно."
     
+    await edit_quietly(message, f"{header}{text}{footer}", retry=True)
+    return text
+
+async def edit_quietly(message, text, retry=False):
+    """edit_text, который не падает на ошибках Telegram («message is not modified», флуд-контроль, таймаут).
+    retry=True — после RetryAfter/TimedOut ещё одна попытка (для финальной правки)"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{GIGACHAT_API_URL}/chat/completions",
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {token}"
-                },
-                json={
-                    "model": "GigaChat-Max",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.8  # Чуть креативности
-                },
-                ssl=ssl_context
-            ) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data["choices"][0]["message"]["content"]
-    except Exception as e:
-        logger.error(f"Keeper text error: {e}")
-    
-    return "Договоренность удержана. Племя спокойно."
+        await message.edit_text(text)
+    except (RetryAfter, TimedOut) as e:
+        if not retry:
+            logger.warning("Edit skipped: %s", e)
+            return
+        await asyncio.sleep(e.retry_after if isinstance(e, RetryAfter) else 1)
+        await edit_quietly(message, text)
+    except TelegramError as e:
+        logger.warning("Edit skipped: %s", e)
 
 # ============== РАБОТА С ДАННЫМИ ==============
 def load_data():
@@ -351,14 +762,17 @@ def load_data():
         "arsenal": {
             "total_created": 0,
             "current_week_tools": [],
-            "week_start": datetime.now(TIMEZONE).strftime("%Y-%m-%d")
+            "week_start": today_str()
         },
         "amber_achieved": False,              # ← СЮДА ДОБАВЬ ЗАПЯТУЮ
         "keeper_streak": 0,                   # ← НОВАЯ СТРОКА
         "waiting_for_keeper": False,          # ← НОВАЯ СТРОКА
-        "keeper_promotion_shown": False,      # ← НОВАЯ СТРОКА
+        "announced_phases": [],               # Объявленные смены роли ("кампания:дата")
         "total_keeper_success": 0,            # ← НОВАЯ СТРОКА
-        "superhero_morning_flag": False       # ← НОВАЯ СТРОКА (запятой не нужно)
+        "superhero_morning_flag": False,      # ← НОВАЯ СТРОКА
+        "timezone": None,                     # Свой часовой пояс (None — Москва)
+        "campaign": None,                     # Кампания из campaigns.json (None — по умолчанию)
+        "schedule": {}                        # Свои времена событий: {"wakeup": "06:15"}
     }                                         # ← эта скобка остается
     try:
         if file_path.exists():
@@ -367,34 +781,199 @@ def load_data():
                 for key in default:
                     if key not in data:
                         data[key] = default[key]
+                # Старый флаг повышения 15 марта → объявленные фазы основной кампании
+                if data.pop("keeper_promotion_shown", False):
+                    for phase in get_campaign().announced_phases:
+                        if phase not in data["announced_phases"]:
+                            data["announced_phases"].append(phase)
                 return data
         return default
     except Exception as e:
-        logger.error(f"Load error: {e}")
+        logger.error("Load error: %s", e)
         return default
 
+_commandments_cache = {"mtime": None, "items": []}
+
 def load_commandments():
-    """Загружает заповеди из JSON (файл рядом с ботом)"""
+    """Загружает заповеди из JSON (файл рядом с ботом); перечитывает, только если файл изменился"""
     file_path = Path(__file__).parent / "commandments.json"
     try:
         if file_path.exists():
-            with open(file_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            mtime = file_path.stat().st_mtime
+            if _commandments_cache["mtime"] != mtime:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    _commandments_cache["items"] = json.load(f)
+                _commandments_cache["mtime"] = mtime
+            return _commandments_cache["items"]
     except Exception as e:
-        logger.error(f"Commandments load error: {e}")
+        logger.error("Commandments load error: %s", e)
     return []
 
 def save_data(data):
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     file_path = DATA_DIR / "stoyanka_data.json"
-    with open(file_path, "w", encoding="utf-8") as f:
+    # Пишем во временный файл и подменяем атомарно: читатель никогда не видит файл наполовину
+    tmp_path = file_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, file_path)
+
+def is_admin(user_id, data):
+    if ADMIN_IDS:
+        return user_id in ADMIN_IDS
+    return user_id == data.get("user_id")
+
+# ============== ЭКСПОРТ / ИМПОРТ ==============
+EXPORT_FORMAT_VERSION = 1
+
+def open_export_stream(path, mode):
+    """Текстовый поток NDJSON; для *.zst — через zstandard (необязательная зависимость)"""
+    if str(path).endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("Для .zst нужен пакет zstandard (pip install zstandard)")
+        raw = open(path, mode + "b")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def iter_export_records():
+    """Записи снимка по одной: meta, user, затем по строке на орудие арсенала.
+    save_data подменяет файл атомарно, поэтому прочитанное состояние — целый снимок на момент чтения."""
+    yield {"type": "meta", "version": EXPORT_FORMAT_VERSION, "exported_at": now_msk().isoformat()}
+    
+    data = load_data()
+    user_id = data.get("user_id")
+    state = {key: value for key, value in data.items() if key != "arsenal"}
+    state["arsenal"] = {key: value for key, value in data["arsenal"].items() if key != "current_week_tools"}
+    yield {"type": "user", "user_id": user_id, "state": state}
+    
+    for n, tool in enumerate(data["arsenal"]["current_week_tools"]):
+        yield {"type": "tool", "user_id": user_id, "n": n, "tool": tool}
+
+def export_state(path):
+    """Пишет снимок в NDJSON построчно, возвращает число записей"""
+    count = 0
+    with open_export_stream(path, "w") as f:
+        for record in iter_export_records():
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def validate_record(record):
+    kind = record.get("type") if isinstance(record, dict) else None
+    if kind == "meta":
+        if record.get("version") != EXPORT_FORMAT_VERSION:
+            raise ValueError(f"неподдерживаемая версия {record.get('version')}")
+    elif kind == "user":
+        state = record.get("state")
+        if not isinstance(state, dict):
+            raise ValueError("нет state")
+        arsenal = state.get("arsenal")
+        if not isinstance(arsenal, dict) or not isinstance(arsenal.get("total_created"), int):
+            raise ValueError("нет arsenal.total_created")
+    elif kind == "tool":
+        tool = record.get("tool")
+        if not isinstance(record.get("n"), int) or record["n"] < 0:
+            raise ValueError("n должно быть неотрицательным числом")
+        if not isinstance(tool, dict) or not {"type", "material"} <= tool.keys():
+            raise ValueError("у орудия нет type/material")
+    else:
+        raise ValueError(f"неизвестный тип записи {kind}")
+
+def apply_import_record(data, record):
+    """Upsert записи: user — поля состояния (арсенал недели начинается заново), tool — позиция n"""
+    if record["type"] == "user":
+        arsenal = data["arsenal"]
+        data.update(record["state"])
+        # Чего нет в снимке (например, week_start) — остаётся от текущего состояния
+        data["arsenal"] = {**arsenal, **record["state"]["arsenal"], "current_week_tools": []}
+    elif record["type"] == "tool":
+        week_tools = data["arsenal"]["current_week_tools"]
+        n = record["n"]
+        if n < len(week_tools):
+            week_tools[n] = record["tool"]
+        else:
+            week_tools.append(record["tool"])
+
+def iter_import_records(path):
+    """Записи файла по одной, с проверкой; ошибка — с номером строки"""
+    with open_export_stream(path, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                validate_record(record)
+            except ValueError as e:
+                raise ValueError(f"Строка {line_no}: {e}")
+            yield record
+
+def import_state(path):
+    """Потоковый импорт в два прохода: сначала проверяется весь файл,
+    затем записи применяются и состояние сохраняется один раз (атомарно).
+    Для миграций — запускать при остановленном боте."""
+    for _ in iter_import_records(path):
+        pass
+    
+    data = load_data()
+    stats = Counter()
+    for record in iter_import_records(path):
+        apply_import_record(data, record)
+        stats[record["type"]] += 1
+    save_data(data)
+    return stats
+
+# ============== ЧАСЫ ==============
+class SystemClock:
+    """Реальное время по Москве"""
+    
+    def now(self):
+        return datetime.now(TIMEZONE)
+
+class SimClock:
+    """Ручные часы для симуляции: время идёт только через advance()"""
+    
+    def __init__(self, start):
+        self.current = start.astimezone(TIMEZONE)
+    
+    def now(self):
+        return self.current
+    
+    def advance(self, minutes=1):
+        self.current = TIMEZONE.normalize(self.current + timedelta(minutes=minutes))
+        return self.current
+
+clock = SystemClock()
+
+def set_clock(new_clock):
+    """Подменяет источник времени для всей логики бота"""
+    global clock
+    clock = new_clock
 
 def now_msk():
-    return datetime.now(TIMEZONE)
+    return clock.now()
+
+def get_user_tz(data):
+    """Часовой пояс пользователя (по умолчанию — Москва)"""
+    name = (data or {}).get("timezone")
+    if name:
+        try:
+            return pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            logger.error("Unknown timezone: %s", name)
+    return TIMEZONE
+
+def user_now(data=None):
+    """Текущее время в часовом поясе пользователя"""
+    return now_msk().astimezone(get_user_tz(data))
 
-def today_str():
-    return now_msk().strftime("%Y-%m-%d")
+def today_str(data=None):
+    return user_now(data).strftime("%Y-%m-%d")
 
 def get_hunger_hours(data):
     last = data.get("last_feed_time")
@@ -411,6 +990,196 @@ def get_hunger_mode(data):
         return "bad"
     return "riot"
 
+# ============== РАСПИСАНИЕ ==============
+ALL_DAYS = frozenset(range(7))
+WORK_DAYS = frozenset(range(5))
+
+# (событие, [(час, минута), ...], дни недели; 0 = понедельник)
+SCHEDULE = [
+    ("wakeup", [(WAKEUP_HOUR, WAKEUP_MINUTE)], ALL_DAYS),
+    ("keeper_check", [(21, 0)], ALL_DAYS),
+    ("superhero", [(4, 0)], WORK_DAYS),
+    ("day_shift", [(9, 0)], WORK_DAYS),
+    ("good_papa", [(18, 0)], WORK_DAYS),
+    ("night_workshop", [(21, 30)], WORK_DAYS),
+    ("saturday_hero", [(8, 0)], frozenset([5])),
+    ("sunday_money", [(9, 0)], frozenset([6])),
+    ("sunday_family", [(15, 0)], frozenset([6])),
+    ("hunger", [(h, m) for h in range(24) for m in (0, 30)], ALL_DAYS),
+    ("dopamine", [(h, 55) for h in range(DOPAMINE_START_HOUR, DOPAMINE_END_HOUR + 1) if h % 2 != 0], ALL_DAYS),
+    ("goodnight", [(23, 0)], ALL_DAYS),
+    ("weekly_report", [(REPORT_HOUR, REPORT_MINUTE)], frozenset([0])),
+]
+
+# События с одним временем можно переносить командой /schedule
+MOVABLE_EVENTS = [name for name, times, _ in SCHEDULE if len(times) == 1]
+
+def get_user_schedule(data):
+    """SCHEDULE с учётом переопределений пользователя"""
+    overrides = data.get("schedule") or {}
+    schedule = []
+    for name, times, weekdays in SCHEDULE:
+        if name in overrides:
+            hour, minute = map(int, overrides[name].split(":"))
+            times = [(hour, minute)]
+        schedule.append((name, times, weekdays))
+    return schedule
+
+def next_fire_ts(tz, times, weekdays, after_ts):
+    """Ближайший момент события строго после after_ts (по местному времени tz)"""
+    after = datetime.fromtimestamp(after_ts, tz)
+    for offset in range(8):
+        day = after.date() + timedelta(days=offset)
+        if day.weekday() not in weekdays:
+            continue
+        for hour, minute in sorted(times):
+            fire = tz.localize(datetime(day.year, day.month, day.day, hour, minute)).timestamp()
+            if fire > after_ts:
+                return fire
+    return None
+
+class Scheduler:
+    """Мин-куча (время срабатывания, пользователь, событие).
+    Проверка — O(1), каждое сработавшее событие — O(log n)."""
+    
+    def __init__(self):
+        self.heap = []
+        self.specs = {}     # user_id -> {событие: (tz, times, weekdays)}
+        self.versions = {}  # user_id -> (пояс, расписание), чтобы заметить изменения
+        self.fired = {}     # user_id -> {событие: ts последнего срабатывания} — переживает рестарт
+    
+    def sync_user(self, user_id, data):
+        """Строит события пользователя заново, если сменился пояс или расписание"""
+        version = (data.get("timezone"), json.dumps(data.get("schedule") or {}, sort_keys=True))
+        if self.versions.get(user_id) == version:
+            return
+        self.versions[user_id] = version
+        
+        tz = get_user_tz(data)
+        now_ts = now_msk().timestamp()
+        fired = self.fired.get(user_id, {})
+        self.specs[user_id] = {}
+        self.heap = [entry for entry in self.heap if entry[1] != user_id]
+        for name, times, weekdays in get_user_schedule(data):
+            self.specs[user_id][name] = (tz, times, weekdays)
+            # После рестарта: что наступило за время простоя — догоняем, что уже было — не повторяем
+            after_ts = max(fired[name], now_ts - MISFIRE_GRACE_SECONDS) if name in fired else now_ts
+            self.heap.append((next_fire_ts(tz, times, weekdays, after_ts), user_id, name))
+        heapq.heapify(self.heap)
+    
+    def next_ts(self):
+        return self.heap[0][0] if self.heap else None
+    
+    def pop_due(self, now_ts):
+        """Наступившие события {user_id: {событие}}; каждое сразу планируется заново"""
+        due = {}
+        while self.heap and self.heap[0][0] <= now_ts:
+            fire_ts, user_id, name = heapq.heappop(self.heap)
+            self.fired.setdefault(user_id, {})[name] = fire_ts
+            if now_ts - fire_ts <= MISFIRE_GRACE_SECONDS:
+                due.setdefault(user_id, set()).add(name)
+            else:
+                logger.warning("Skipped stale event %s", name, extra={"user_id": user_id})
+            tz, times, weekdays = self.specs[user_id][name]
+            heapq.heappush(self.heap, (next_fire_ts(tz, times, weekdays, now_ts), user_id, name))
+        return due
+
+scheduler = Scheduler()
+
+async def scheduler_job(context: ContextTypes.DEFAULT_TYPE):
+    """Срабатывает только к ближайшему событию, затем взводит себя снова"""
+    try:
+        await main_timer(context)
+    finally:
+        save_runtime_snapshot()
+        arm_scheduler(context.job_queue)
+
+def arm_scheduler(job_queue):
+    for job in job_queue.get_jobs_by_name("scheduler"):
+        job.schedule_removal()
+    next_ts = scheduler.next_ts()
+    # Пока пользователя нет, заглядываем раз в минуту
+    delay = 60 if next_ts is None else max(1, next_ts - now_msk().timestamp())
+    job_queue.run_once(scheduler_job, when=delay, name="scheduler")
+
+# ============== КАМПАНИИ ==============
+ROLE_NAMES = {"keeper": "Хранитель соглашений", "elder": "Старший стоянки"}
+
+# План дня: роль, текст объявления новой роли (или None), ключ фазы, события дня
+DayPlan = namedtuple("DayPlan", "role announce phase events")
+
+class Campaign:
+    """Кампания из campaigns.json, заранее развёрнутая в таблицу дней (дата -> DayPlan).
+    Любая проверка роли и событий дня — один поиск в словаре."""
+    
+    def __init__(self, campaign_id, spec):
+        self.id = campaign_id
+        self.title = spec.get("title", campaign_id)
+        self.start = TIMEZONE.localize(datetime.strptime(spec["start"], "%Y-%m-%d %H:%M"))
+        self.end = TIMEZONE.localize(datetime.strptime(spec["end"], "%Y-%m-%d %H:%M"))
+        self.target = spec["target"]
+        self.ritual_every = spec["ritual_every"]
+        
+        enabled = set(spec.get("events") or [name for name, _, _ in SCHEDULE])
+        weekday_events = [frozenset(name for name, _, weekdays in SCHEDULE
+                                    if weekday in weekdays and name in enabled)
+                          for weekday in range(7)]
+        phases = sorted(spec["phases"], key=lambda p: p["from"])
+        
+        # С запасом в день с каждой стороны: местная дата пользователя может отличаться от московской
+        self.first_day = self.start.date() - timedelta(days=1)
+        self.last_day = self.end.date() + timedelta(days=1)
+        self.days = {}
+        day = self.first_day
+        phase = phases[0]
+        while day <= self.last_day:
+            for candidate in phases:
+                if candidate["from"] <= day.isoformat():
+                    phase = candidate
+            announce = phase.get("announce") if phase["from"] == day.isoformat() else None
+            self.days[day] = DayPlan(phase["role"], announce, f"{campaign_id}:{phase['from']}",
+                                     weekday_events[day.weekday()])
+            day += timedelta(days=1)
+    
+    def active(self, moment):
+        return self.start <= moment < self.end
+    
+    def plan(self, day):
+        """План на дату; до и после кампании — как в её первый/последний день"""
+        return self.days[min(max(day, self.first_day), self.last_day)]
+    
+    def is_ritual(self, n):
+        return n % self.ritual_every == 0
+    
+    @property
+    def announced_phases(self):
+        """Ключи фаз, у которых есть объявление"""
+        return [plan.phase for plan in self.days.values() if plan.announce]
+
+_campaigns = {"default": None, "items": {}}
+
+def load_campaigns():
+    """Компилирует все кампании из CAMPAIGNS_FILE (один раз за запуск)"""
+    if not _campaigns["items"]:
+        with open(CAMPAIGNS_FILE, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        for campaign_id, spec in config["campaigns"].items():
+            _campaigns["items"][campaign_id] = Campaign(campaign_id, spec)
+        _campaigns["default"] = _campaigns["items"][config["default"]]
+    return _campaigns["items"]
+
+def get_campaign(data=None):
+    """Кампания пользователя (по умолчанию — основная)"""
+    campaigns = load_campaigns()
+    campaign_id = (data or {}).get("campaign")
+    if campaign_id and campaign_id not in campaigns:
+        logger.error("Unknown campaign: %s", campaign_id)
+    return campaigns.get(campaign_id) or _campaigns["default"]
+
+def current_plan(data):
+    """План на сегодняшнюю (местную) дату пользователя"""
+    return get_campaign(data).plan(user_now(data).date())
+
 # ============== ПРОМПТЫ (ЗИМНЕ-ВЕСЕННИЕ) ==============
 def get_sunrise_prompt():
     return ("Early Mesolithic winter morning on the Russian Plain, site near Dubna river, "
@@ -446,26 +1215,333 @@ def get_amber_prompt():
             "dressed in fur clothing, photorealistic, 8k, detailed weathered hands, "
             "dramatic side lighting, archaeological reconstruction")
 
+# ============== ОТПРАВКА АЛЬБОМОВ ==============
+class AlbumBatch:
+    """Собирает картинки одного события и отправляет их одним запросом"""
+    
+    def __init__(self):
+        self.items = []  # (bytes, подпись)
+    
+    def add(self, photo, caption=None):
+        self.items.append((photo, caption))
+    
+    async def send(self, bot, chat_id, text=None):
+        """Отправляет событие: текст становится подписью первой картинки.
+        1 картинка — send_photo, 2+ — send_media_group равными пачками не больше ALBUM_LIMIT
+        (альбом из одной картинки Telegram не принимает)."""
+        items = list(self.items)
+        if text and items:
+            first_photo, first_caption = items[0]
+            merged = f"{text}\n\n{first_caption}" if first_caption else text
+            if len(merged) <= CAPTION_LIMIT:
+                items[0] = (first_photo, merged)
+                text = None
+        if text:
+            await bot.send_message(chat_id=chat_id, text=text)
+        
+        if len(items) == 1:
+            photo, caption = items[0]
+            await bot.send_photo(chat_id=chat_id, photo=BytesIO(photo), caption=caption)
+            return
+        chunks = -(-len(items) // ALBUM_LIMIT)
+        start = 0
+        for i in range(chunks):
+            end = len(items) * (i + 1) // chunks
+            media = [InputMediaPhoto(photo, caption=caption)
+                     for photo, caption in items[start:end]]
+            await bot.send_media_group(chat_id=chat_id, media=media)
+            start = end
+
+# ============== ОБРАБОТКА КАРТИНОК ==============
+_process_pool = None
+
+def get_process_pool():
+    """Пул процессов для тяжёлой обработки картинок (вне event loop)"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _process_pool
+
+def warm_worker():
+    """Заранее поднимает процесс пула и импортирует Pillow"""
+    from PIL import Image  # noqa: F401
+    return os.getpid()
+
+def optimize_image(raw):
+    """Уменьшает, пережимает в progressive JPEG и убирает метаданные
+    (выполняется в пуле процессов)"""
+    from PIL import Image, ImageOps
+    
+    with Image.open(BytesIO(raw)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        buf = BytesIO()
+        # EXIF/ICC не передаём — в файл попадают только пиксели
+        img.save(buf, "JPEG", quality=IMAGE_QUALITY, progressive=True, optimize=True)
+    return buf.getvalue()
+
+image_cache_index = {}  # ключ промпта -> имена файлов, от старых к новым
+
+def image_cache_key(prompt):
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:16]
+
+def rebuild_image_cache_index():
+    """Индекс кэша по содержимому папки (если нет снимка)"""
+    image_cache_index.clear()
+    if IMAGE_CACHE_DIR.exists():
+        for path in sorted(IMAGE_CACHE_DIR.glob("*.jpg")):
+            image_cache_index.setdefault(path.stem.split("_")[0], []).append(path.name)
+
+def cache_image(prompt, img_data):
+    """Кладёт картинку в кэш, оставляя последние IMAGE_CACHE_PER_PROMPT на промпт"""
+    IMAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    key = image_cache_key(prompt)
+    path = IMAGE_CACHE_DIR / f"{key}_{int(now_msk().timestamp() * 1000)}.jpg"
+    with open(path, "wb") as f:
+        f.write(img_data)
+    names = image_cache_index.setdefault(key, [])
+    names.append(path.name)
+    while len(names) > IMAGE_CACHE_PER_PROMPT:
+        (IMAGE_CACHE_DIR / names.pop(0)).unlink(missing_ok=True)
+    return path
+
+def get_cached_image(prompt):
+    """Случайная из последних картинок по этому промпту или None"""
+    names = image_cache_index.get(image_cache_key(prompt))
+    if not names:
+        return None
+    try:
+        with open(IMAGE_CACHE_DIR / random.choice(names), "rb") as f:
+            return f.read()
+    except OSError as e:
+        logger.warning("Cached image read error: %s", e)
+        return None
+
+async def postprocess_image(prompt, raw):
+    """Обработка картинки после генерации без блокировки event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        img_data = await loop.run_in_executor(get_process_pool(), optimize_image, raw)
+    except Exception as e:
+        logger.error("Image postprocess error: %s", e)
+        return raw
+    try:
+        cache_image(prompt, img_data)
+    except OSError as e:
+        logger.error("Image cache error: %s", e)
+    return img_data
+
+# ============== КОЛЛАЖ НЕДЕЛИ ==============
+def save_tool_image(num, img_data):
+    """Сохраняет картинку орудия на диск, возвращает имя файла"""
+    IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+    name = f"tool_{num}.jpg"
+    with open(IMAGES_DIR / name, "wb") as f:
+        f.write(img_data)
+    return name
+
+def get_week_images(week_tools):
+    """Список (путь, подпись) для орудий недели, у которых есть картинка"""
+    items = []
+    for t in week_tools:
+        name = t.get("image")
+        if not name or not (IMAGES_DIR / name).exists():
+            continue
+        caption = f"{t['material']} {t['type']}" + (" (ритуальное)" if t.get("ritual") else "")
+        items.append((str(IMAGES_DIR / name), caption))
+    return items
+
+def _load_font(size):
+    from PIL import ImageFont
+    for name in ("DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+def build_collage(items):
+    """Собирает сетку из картинок орудий с подписями (выполняется в пуле процессов)"""
+    from PIL import Image, ImageDraw, ImageOps
+    
+    columns = min(COLLAGE_COLUMNS, len(items))
+    rows = (len(items) + columns - 1) // columns
+    cell_height = COLLAGE_TILE + COLLAGE_CAPTION_HEIGHT
+    canvas = Image.new("RGB", (columns * COLLAGE_TILE, rows * cell_height), (28, 22, 18))
+    draw = ImageDraw.Draw(canvas)
+    font = _load_font(16)
+    
+    for i, (path, caption) in enumerate(items):
+        x = (i % columns) * COLLAGE_TILE
+        y = (i // columns) * cell_height
+        with Image.open(path) as img:
+            tile = ImageOps.fit(img.convert("RGB"), (COLLAGE_TILE, COLLAGE_TILE))
+        canvas.paste(tile, (x, y))
+        
+        text_width = draw.textlength(caption, font=font)
+        draw.text((x + (COLLAGE_TILE - text_width) / 2, y + COLLAGE_TILE + 12),
+                  caption, font=font, fill=(235, 215, 180))
+    
+    buf = BytesIO()
+    canvas.save(buf, "JPEG", quality=85, optimize=True)
+    return buf.getvalue()
+
+async def make_week_collage(items):
+    """Коллаж без блокировки event loop; None при ошибке"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_process_pool(), build_collage, items)
+    except Exception as e:
+        logger.error("Collage error: %s", e)
+    return None
+
+def load_album(items):
+    """Альбом из картинок недели (запасной вариант, если коллаж не собрался)"""
+    album = AlbumBatch()
+    for path, text in items:
+        with open(path, "rb") as f:
+            album.add(f.read(), text)
+    return album
+
+# ============== ОГРАНИЧЕНИЕ ВХОДЯЩИХ ==============
+# Класс команд: ёмкость корзины, пополнение в минуту, окно склейки повторов (сек)
+INGRESS_POLICY = {
+    "tools": {"burst": 3, "per_minute": 2, "debounce": 3.0},   # /done, «сделал»
+    "feed": {"burst": 5, "per_minute": 4, "debounce": 0},      # /tried, /penalty, /penalty20
+    "status": {"burst": 3, "per_minute": 6, "debounce": 0},    # /status
+}
+
+def load_ingress_policy():
+    """INGRESS_POLICY с переопределениями из окружения: INGRESS_POLICY='{"tools": {"burst": 3}}'"""
+    policy = {cls: dict(rule) for cls, rule in INGRESS_POLICY.items()}
+    try:
+        overrides = json.loads(os.environ.get("INGRESS_POLICY", "{}"))
+        for cls, override in overrides.items():
+            policy.setdefault(cls, {"burst": 5, "per_minute": 4, "debounce": 0}).update(override)
+    except (ValueError, AttributeError, TypeError) as e:
+        logger.error("Bad INGRESS_POLICY, using defaults: %s", e)
+        return {cls: dict(rule) for cls, rule in INGRESS_POLICY.items()}
+    return policy
+
+class IngressLimiter:
+    """Корзина токенов на (пользователь, класс команд) и склейка быстрых повторов"""
+    
+    def __init__(self, policy):
+        self.policy = policy
+        self.buckets = {}  # (user_id, класс) -> [токены, ts пополнения, предупреждён]
+        self.pending = {}  # (user_id, класс) -> [число повторов в открытом окне, callback]
+    
+    def allow(self, user_id, command_class):
+        """Берёт токен; False — лимит исчерпан"""
+        rule = self.policy[command_class]
+        now_ts = now_msk().timestamp()
+        bucket = self.buckets.setdefault((user_id, command_class), [rule["burst"], now_ts, False])
+        bucket[0] = min(rule["burst"], bucket[0] + (now_ts - bucket[1]) * rule["per_minute"] / 60)
+        bucket[1] = now_ts
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True
+        return False
+    
+    def should_warn(self, user_id, command_class):
+        """Предупреждаем об ограничении один раз, а не на каждое сообщение"""
+        bucket = self.buckets[(user_id, command_class)]
+        if bucket[2]:
+            return False
+        bucket[2] = True
+        return True
+    
+    async def debounce(self, user_id, command_class, context, callback):
+        """Первое сообщение обрабатывается сразу; повторы, пришедшие пока оно обрабатывается
+        или в течение окна после, копятся и уходят одним callback(context, user_id, число).
+        Окно отсчитывается от конца обработки: апдейты идут по одному, и повторы,
+        ждавшие в очереди за долгой генерацией, должны склеиться, а не открыть новое окно."""
+        window = self.policy[command_class]["debounce"]
+        job_queue = getattr(context, "job_queue", None)
+        if window <= 0 or job_queue is None:
+            await callback(context, user_id, 1)
+            return
+        
+        key = (user_id, command_class)
+        if key in self.pending:
+            # Склейка фиксируется до любого await
+            self.pending[key][0] += 1
+            return
+        self.pending[key] = [0, callback]
+        try:
+            await callback(context, user_id, 1)
+        finally:
+            self.schedule_flush(job_queue, key, window)
+    
+    def schedule_flush(self, job_queue, key, window):
+        job_queue.run_once(self.flush, when=window, data=key,
+                           name=f"debounce:{key[0]}:{key[1]}")
+    
+    async def flush(self, context: ContextTypes.DEFAULT_TYPE):
+        """Закрытие окна: накопленное — одной пачкой, и окно открывается снова, пока идут повторы"""
+        key = context.job.data
+        entry = self.pending.get(key)
+        if not entry:
+            return
+        count, callback = entry
+        if not count:
+            del self.pending[key]
+            return
+        entry[0] = 0
+        try:
+            await callback(context, key[0], count)
+        finally:
+            self.schedule_flush(context.job_queue, key, self.policy[key[1]]["debounce"])
+    
+    async def flush_all(self, context):
+        """Досылает всё накопленное, не дожидаясь окон (перед остановкой бота)"""
+        for key in list(self.pending):
+            count, callback = self.pending.pop(key)
+            if count:
+                try:
+                    await callback(context, key[0], count)
+                except Exception as e:
+                    logger.error("Pending flush error: %s", e, extra={"user_id": key[0]})
+
+ingress = IngressLimiter(load_ingress_policy())
+
+def throttled(command_class):
+    """Пропускает хендлер, только если у пользователя есть токен для этого класса команд"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update, context):
+            user_id = update.effective_user.id
+            if ingress.allow(user_id, command_class):
+                return await func(update, context)
+            logger.info("throttled", extra={"handler": func.__name__, "user_id": user_id})
+            if ingress.should_warn(user_id, command_class):
+                await update.message.reply_text("⏳ Не так быстро, Мастер. Кремень не любит суеты — попробуй чуть позже.")
+        return wrapper
+    return decorator
+
 # ============== ОБРАБОТЧИКИ ==============
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     data = load_data()
     data["user_id"] = user_id
-    data["current_date"] = today_str()
+    data["current_date"] = today_str(data)
     if not data["last_feed_time"]:
         data["last_feed_time"] = now_msk().isoformat()
     save_data(data)
     
+    campaign = get_campaign(data)
     await update.message.reply_text(
         "⚒️ ДЕЛАТЕЛЬ ОРУДИЙ — МЕЗОЛИТ РУССКОЙ РАВНИНЫ\n\n"
         "Твоя задача: ковать орудия для охотников.\n\n"
         "Команды:\n"
-        "/done или 'сделал' — Орудие готово (+12ч, +18ч каждое 10-е)\n"
+        f"/done или 'сделал' — Орудие готово (+12ч, +18ч каждое {campaign.ritual_every}-е)\n"
         "/tried или 'попробовал' — Работаю над формой (+4ч)\n"
         "/penalty — Неудача в мастерской (-1ч)\n"
         "/penalty20 — Катастрофа в мастерской (-20ч)\n"
         "/status — Проверить запасы\n\n"
-        "Цель: создать 76 орудия до 11 апреля и получить Янтарь с Балтики.\n"
+        f"Цель: создать {campaign.target} {tools_word(campaign.target)} до {campaign.end:%d.%m} "
+        "и получить Янтарь с Балтики.\n"
         "Утром спрошу про твои дела."
     )
 
@@ -483,7 +1559,7 @@ async def handle_plans_response(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("✅ Отлично, Мастер! План есть — племя будет сыто.")
         
         # Генерация рассвета
-        img_data = await gigachat.generate_image(get_sunrise_prompt())
+        img_data = await get_image(get_sunrise_prompt(), "sunrise", user_id)
         if img_data:
             await context.bot.send_photo(chat_id=user_id, photo=BytesIO(img_data),
                                        caption="🌅 Рассвет в мастерской. День обещает быть плодотворным.")
@@ -508,97 +1584,145 @@ async def handle_plans_response(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         await update.message.reply_text("Ответь просто: 'есть' или 'нет'")
 
+@throttled("tools")
 async def cmd_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not (BOT_START <= now_msk() < BOT_END):
+    data = load_data()
+    if not get_campaign(data).active(now_msk()):
         await update.message.reply_text("Бот неактивен.")
         return
     
-    data = load_data()
-    
     # Проверяем, не ждём ли ответ о планах
     if data.get("waiting_for_plans"):
         await update.message.reply_text("Сначала ответь: есть ли у тебя 4 дела? (есть/нет)")
         return
     
-    # Определяем, ритуальное ли это изделие (каждое 10-е)
-    current_total = data["arsenal"]["total_created"]
-    next_num = current_total + 1
-    is_ritual = (next_num % 10 == 0)
-    
-    # Выбор типа и материала
-    tool_type_key = random.choice(list(TOOL_TYPES.keys()))
-    material_key = random.choice(list(MATERIALS.keys()))
+    # Первое «сделал» — сразу; быстрые повторы за ним склеиваются в одну пачку и один ответ
+    await ingress.debounce(update.effective_user.id, "tools", context, create_tools)
+
+def tools_word(n):
+    if n % 10 == 1 and n % 100 != 11:
+        return "орудие"
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return "орудия"
+    return "орудий"
+
+_tools_locks = {}  # user_id -> asyncio.Lock
+
+async def create_tools(context: ContextTypes.DEFAULT_TYPE, user_id, count):
+    """Создаёт count орудий: одна картинка и одно сообщение на всю пачку.
+    Пачки одного пользователя идут по очереди (хендлер и задача склейки работают параллельно)."""
+    async with _tools_locks.setdefault(user_id, asyncio.Lock()):
+        await _create_tools(context, user_id, count)
+
+async def _create_tools(context, user_id, count):
+    data = load_data()
+    campaign = get_campaign(data)
+    created = []
+    total_bonus = 0
     
-    # 10% шанс на обсидиан (редкий)
-    if random.random() < 0.1:
-        material_key = "obsidian"
+    for _ in range(count):
+        # Определяем, ритуальное ли это изделие (каждое ritual_every-е)
+        next_num = data["arsenal"]["total_created"] + 1
+        is_ritual = campaign.is_ritual(next_num)
+        
+        # Выбор типа и материала
+        tool_type_key = random.choice(list(TOOL_TYPES.keys()))
+        material_key = random.choice(list(MATERIALS.keys()))
+        
+        # 10% шанс на обсидиан (редкий)
+        if random.random() < 0.1:
+            material_key = "obsidian"
+        
+        # Обновление времени (12 или 18 часов)
+        bonus_hours = 18 if is_ritual else 12
+        total_bonus += bonus_hours
+        current_hunger = get_hunger_hours(data)
+        new_hunger = current_hunger - bonus_hours
+        new_feed_time = now_msk() - timedelta(hours=new_hunger)
+        
+        data["last_feed_time"] = new_feed_time.isoformat()
+        data["hunger_notified"] = False
+        
+        # Обновление арсенала
+        tool = {
+            "date": today_str(data),
+            "type": TOOL_TYPES[tool_type_key],
+            "material": MATERIALS[material_key],
+            "ritual": is_ritual
+        }
+        data["arsenal"]["total_created"] = next_num
+        data["arsenal"]["current_week_tools"].append(tool)
+        created.append((next_num, tool))
     
-    tool_name = TOOL_TYPES[tool_type_key]
-    material_name = MATERIALS[material_key]
+    # Янтарь (цель кампании)
+    amber = any(num == campaign.target for num, _ in created) and not data.get("amber_achieved")
+    if amber:
+        data["amber_achieved"] = True
     
-    # Генерация картинки
-    prompt = get_tool_prompt(tool_name, material_name, is_ritual)
-    img_data = await gigachat.generate_image(prompt)
+    # Орудия сохраняются до генерации картинки: пока она идёт, состояние читают другие хендлеры
+    save_data(data)
     
-    # Обновление времени (12 или 18 часов)
-    bonus_hours = 18 if is_ritual else 12
-    current_hunger = get_hunger_hours(data)
-    new_hunger = current_hunger - bonus_hours
-    new_feed_time = now_msk() - timedelta(hours=new_hunger)
+    # Генерация картинки — одна на пачку: ритуальное изделие, иначе последнее
+    image_num, image_tool = next((c for c in created if c[1]["ritual"]), created[-1])
+    prompt = get_tool_prompt(image_tool["type"], image_tool["material"], image_tool["ritual"])
+    img_data = await get_image(prompt, "tool", user_id)
+    if img_data:
+        attach_tool_image(image_num, image_tool, save_tool_image(image_num, img_data))
     
-    data["last_feed_time"] = new_feed_time.isoformat()
-    data["hunger_notified"] = False
-    
-    # Обновление арсенала
-    data["arsenal"]["total_created"] = next_num
-    data["arsenal"]["current_week_tools"].append({
-        "date": today_str(),
-        "type": tool_name,
-        "material": material_name,
-        "ritual": is_ritual
-    })
+    # Все картинки события уходят одним альбомом
+    album = AlbumBatch()
+    if img_data:
+        album.add(img_data)
     
-    # Проверка на Янтарь (76 орудия)
-    if next_num == 76 and not data.get("amber_achieved"):
-        data["amber_achieved"] = True
-        amber_img = await gigachat.generate_image(get_amber_prompt())
+    if amber:
+        amber_img = await get_image(get_amber_prompt(), "amber", user_id)
         if amber_img:
-            await context.bot.send_photo(
-                chat_id=data["user_id"], 
-                photo=BytesIO(amber_img),
-                caption="🎉 Великое достижение! Ты создал 76 орудия. "
-                        "Племя обменяло их на Янтарь с Балтики. "
-                        "Твой статус — Легендарный Мастер."
-            )
-    
-    save_data(data)
+            album.add(amber_img,
+                      f"🎉 Великое достижение! Ты создал {campaign.target} {tools_word(campaign.target)}. "
+                      "Племя обменяло их на Янтарь с Балтики. "
+                      "Твой статус — Легендарный Мастер.")
     
     # Отправка результата
-    if is_ritual:
-        text = (f"⚡ РИТУАЛЬНОЕ ИЗДЕЛИЕ! ({next_num}-е)\n"
-                f"⚒️ Создано: {material_name} {tool_name}\n"
+    if count > 1:
+        lines = "\n".join(f"• {t['material']} {t['type']}" + (" ⚡" if t["ritual"] else "")
+                          for _, t in created)
+        text = (f"⚒️ {count} {tools_word(count)} создано:\n{lines}\n"
+                f"⏳ +{total_bonus} часов сытости")
+    elif image_tool["ritual"]:
+        text = (f"⚡ РИТУАЛЬНОЕ ИЗДЕЛИЕ! ({image_num}-е)\n"
+                f"⚒️ Создано: {image_tool['material']} {image_tool['type']}\n"
                 f"✨ Украшено орнаментом ёлочкой и насечками\n"
-                f"⏳ +{bonus_hours} часов сытости")
+                f"⏳ +{total_bonus} часов сытости")
     else:
-        text = (f"⚒️ Создано: {material_name} {tool_name}\n"
-                f"⏳ +{bonus_hours} часов сытости")
+        text = (f"⚒️ Создано: {image_tool['material']} {image_tool['type']}\n"
+                f"⏳ +{total_bonus} часов сытости")
     
-    await update.message.reply_text(text)
-    
-    if img_data:
-        await context.bot.send_photo(chat_id=update.effective_user.id, photo=BytesIO(img_data))
-    else:
-        await update.message.reply_text("(Изображение временно недоступно)")
+    if not img_data:
+        text += "\n(Изображение временно недоступно)"
     
     # Информация о прогрессе
-    await update.message.reply_text(f"📊 Всего создано: {next_num}/76")
+    text += f"\n\n📊 Всего создано: {data['arsenal']['total_created']}/{campaign.target}"
+    
+    await album.send(context.bot, user_id, text=text)
+
+def attach_tool_image(num, tool, path):
+    """Путь картинки — в уже сохранённое орудие (состояние перечитывается после генерации)"""
+    data = load_data()
+    week_tools = data["arsenal"]["current_week_tools"]
+    # Орудие num лежит на своём месте от конца недели, если неделю за это время не сбросили
+    index = len(week_tools) - (data["arsenal"]["total_created"] - num) - 1
+    if 0 <= index < len(week_tools) and week_tools[index] == tool:
+        week_tools[index]["image"] = path
+        save_data(data)
+    tool["image"] = path
 
+@throttled("feed")
 async def cmd_tried(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not (BOT_START <= now_msk() < BOT_END):
+    data = load_data()
+    if not get_campaign(data).active(now_msk()):
         await update.message.reply_text("Бот неактивен.")
         return
     
-    data = load_data()
     current_hunger = get_hunger_hours(data)
     new_hunger = current_hunger - 4
     new_feed_time = now_msk() - timedelta(hours=new_hunger)
@@ -613,13 +1737,14 @@ async def cmd_tried(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     await update.message.reply_text(random.choice(phrases))
 
+@throttled("feed")
 async def cmd_penalty(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Штраф -1 час (без крыс, аутентично)"""
-    if not (BOT_START <= now_msk() < BOT_END):
+    data = load_data()
+    if not get_campaign(data).active(now_msk()):
         await update.message.reply_text("Бот неактивен.")
         return
     
-    data = load_data()
     current_hunger = get_hunger_hours(data)
     new_hunger = current_hunger + 1
     new_feed_time = now_msk() - timedelta(hours=new_hunger)
@@ -637,13 +1762,14 @@ async def cmd_penalty(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     await update.message.reply_text(random.choice(penalties))
 
+@throttled("feed")
 async def cmd_penalty20(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Жесткий штраф -20 часов (катастрофа)"""
-    if not (BOT_START <= now_msk() < BOT_END):
+    data = load_data()
+    if not get_campaign(data).active(now_msk()):
         await update.message.reply_text("Бот неактивен.")
         return
     
-    data = load_data()
     current_hunger = get_hunger_hours(data)
     new_hunger = current_hunger + 20  # +20 часов голода = -20 часов сытости
     new_feed_time = now_msk() - timedelta(hours=new_hunger)
@@ -660,11 +1786,14 @@ async def cmd_penalty20(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     await update.message.reply_text(random.choice(hard_penalties))    
 
+@throttled("status")
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = load_data()
     hours = get_hunger_hours(data)
     mode = get_hunger_mode(data)
     total = data["arsenal"]["total_created"]
+    campaign = get_campaign(data)
+    target = campaign.target
     
     if mode == "good":
         status = f"✅ Мастерская работает\n⏳ До кризиса: {HUNGER_WARNING_HOURS - hours:.1f} ч."
@@ -678,55 +1807,160 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         emoji = "😡"
     
     msg = (f"📊 СТАТУС ДЕЛАТЕЛЯ {emoji}\n\n"
-           f"⚒️ Орудий создано: {total}/76\n"
+           f"⚒️ Орудий создано: {total}/{target}\n"
            f"⏱️ Без дела: {hours:.1f} ч.\n"
            f"{status}\n\n")
     
-    if total >= 76:
+    if total >= target:
         msg += "🟡 Янтарь с Балтики получен!"
     else:
-        msg += f"🎯 Осталось до Янтаря: {76 - total}"
+        msg += f"🎯 Осталось до Янтаря: {target - total}"
     
     # Блок второй оси: Хранитель/Старший
-    now = now_msk()
-    if now.month > 3 or (now.month == 3 and now.day >= 15):
-        current_role = "Старший стоянки"
-    else:
-        current_role = "Хранитель соглашений"
+    current_role = ROLE_NAMES[current_plan(data).role]
     
     streak = data.get("keeper_streak", 0)
     msg += f"\n\n⚖️ {current_role}\n🔥 Серия: {streak} дней"
-    msg += "\n\n📋 Команды:\n/done или 'сделал' — Орудие готово (+12ч, +18ч каждое 10-е)\n/tried или 'попробовал' — Работаю над формой (+4ч)\n/penalty — Неудача в мастерской (-1ч)\n/status — Проверить запасы"
+    msg += f"\n\n📋 Команды:\n/done или 'сделал' — Орудие готово (+12ч, +18ч каждое {campaign.ritual_every}-е)\n/tried или 'попробовал' — Работаю над формой (+4ч)\n/penalty — Неудача в мастерской (-1ч)\n/status — Проверить запасы"
     await update.message.reply_text(msg)
 
-# ============== ТАЙМЕРЫ ==============
-async def main_timer(context: ContextTypes.DEFAULT_TYPE):
-    if not (BOT_START <= now_msk() < BOT_END):
+async def cmd_tz(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/tz Europe/Samara — свой часовой пояс, /tz default — Москва"""
+    data = load_data()
+    if not context.args:
+        await update.message.reply_text(
+            f"🕰 Часовой пояс: {get_user_tz(data).zone}\n"
+            "Сменить: /tz Europe/Samara (или /tz default)"
+        )
         return
     
+    name = context.args[0]
+    if name == "default":
+        data["timezone"] = None
+    else:
+        try:
+            pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            await update.message.reply_text(f"Не знаю такого пояса: {name}")
+            return
+        data["timezone"] = name
+    save_data(data)
+    scheduler.sync_user(update.effective_user.id, data)
+    arm_scheduler(context.job_queue)
+    await update.message.reply_text(f"🕰 Часовой пояс: {get_user_tz(data).zone}")
+
+async def cmd_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/schedule wakeup 06:15 — перенести событие, /schedule wakeup default — вернуть"""
+    data = load_data()
+    overrides = data.get("schedule") or {}
+    
+    if len(context.args) != 2 or context.args[0] not in MOVABLE_EVENTS:
+        lines = []
+        for name, times, _ in get_user_schedule(data):
+            if name in MOVABLE_EVENTS:
+                hour, minute = times[0]
+                mark = " ✏️" if name in overrides else ""
+                lines.append(f"• {name} — {hour:02d}:{minute:02d}{mark}")
+        await update.message.reply_text(
+            "🗓 Расписание:\n" + "\n".join(lines) +
+            "\n\nПеренести: /schedule wakeup 06:15 (или /schedule wakeup default)"
+        )
+        return
+    
+    name, value = context.args
+    if value == "default":
+        overrides.pop(name, None)
+    else:
+        try:
+            fire_time = datetime.strptime(value, "%H:%M")
+        except ValueError:
+            await update.message.reply_text("Время в формате ЧЧ:ММ, например 06:15")
+            return
+        overrides[name] = fire_time.strftime("%H:%M")
+    data["schedule"] = overrides
+    save_data(data)
+    scheduler.sync_user(update.effective_user.id, data)
+    arm_scheduler(context.job_queue)
+    await update.message.reply_text(f"🗓 {name}: {overrides.get(name, 'по умолчанию')}")
+
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [zst] — снимок состояния в NDJSON, не останавливая бота"""
+    if not is_admin(update.effective_user.id, load_data()):
+        return
+    
+    suffix = ".ndjson.zst" if context.args and context.args[0] == "zst" else ".ndjson"
+    export_dir = DATA_DIR / "exports"
+    export_dir.mkdir(parents=True, exist_ok=True)
+    path = export_dir / f"stoyanka_{now_msk():%Y%m%d_%H%M%S}{suffix}"
+    
+    loop = asyncio.get_running_loop()
+    try:
+        count = await loop.run_in_executor(None, export_state, path)
+    except RuntimeError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+        return
+    except OSError as e:
+        logger.error("Export error: %s", e, extra={"handler": "cmd_export"})
+        path.unlink(missing_ok=True)
+        await update.message.reply_text(f"⚠️ Экспорт не удался: {e}")
+        return
+    with open(path, "rb") as f:
+        await context.bot.send_document(
+            chat_id=update.effective_user.id,
+            document=f,
+            filename=path.name,
+            caption=f"📦 Экспорт: {count} записей"
+        )
+
+async def cmd_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/usage — расход GigaChat за день и месяц против бюджета"""
+    if not is_admin(update.effective_user.id, load_data()):
+        return
+    
+    state = usage.load()
+    levels = ["обычный", "картинки из кэша", "тексты из кэша", "только текст"]
+    lines = [f"📈 GIGACHAT — режим: {levels[usage.level()]}"]
+    for period, title in (("daily", "Сегодня"), ("monthly", "Месяц")):
+        totals = state[period]
+        limits = GIGACHAT_BUDGET[period]
+        lines.append(f"\n{title}: вызовов {totals['calls']}, "
+                     f"картинок {totals['images']}/{limits['images'] or '∞'}, "
+                     f"токенов {totals['tokens']}/{limits['tokens'] or '∞'}")
+        for purpose, counts in sorted(totals["purposes"].items()):
+            lines.append(f"• {purpose}: {counts['calls']} выз., {counts['images']} карт., {counts['tokens']} ток.")
+    lines.append(f"\n🪵 Потеряно записей лога (очередь переполнена): {log_handler.dropped}")
+    await update.message.reply_text("\n".join(lines))
+
+# ============== ТАЙМЕРЫ ==============
+async def main_timer(context: ContextTypes.DEFAULT_TYPE):
     data = load_data()
     user_id = data.get("user_id")
     if not user_id:
         return
     
-    now = now_msk()
-    current_hour, current_minute = now.hour, now.minute
-    current_weekday = now.weekday()  # 0=Monday
+    # Наступившие события снимаются с кучи даже вне кампании
+    scheduler.sync_user(user_id, data)
+    due = scheduler.pop_due(now_msk().timestamp()).get(user_id, set())
+    logger.debug("timer tick", extra={"user_id": user_id, "events": sorted(due)})
+    
+    campaign = get_campaign(data)
+    if not campaign.active(now_msk()):
+        return
+    
+    now = user_now(data)
+    plan = campaign.plan(now.date())
+    # Только события, включённые в кампанию на этот день
+    due &= plan.events
 
-    # Повышение 15 марта (одноразовое сообщение)
-    if now.month == 3 and now.day == 15 and not data.get("keeper_promotion_shown"):
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="📜 Приказ Совета племени: ты повышен до Старшего стоянки — "
-                 "координация ресурсов и людей без сакральной власти. "
-                 "Серия сохранена. Продолжай удерживать порядок."
-        )
-        data["keeper_promotion_shown"] = True
+    # Смена роли (одноразовое сообщение в первый день фазы)
+    if plan.announce and plan.phase not in data["announced_phases"]:
+        await context.bot.send_message(chat_id=user_id, text=plan.announce)
+        data["announced_phases"].append(plan.phase)
         save_data(data)
         
     # Сброс дня
-    if data.get("current_date") != today_str():
-        data["current_date"] = today_str()
+    if data.get("current_date") != today_str(data):
+        data["current_date"] = today_str(data)
         data["morning_done"] = False
         data["waiting_for_plans"] = False
         data["waiting_for_keeper"] = False  # ← СЮДА
@@ -737,7 +1971,7 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
         save_data(data)
     
         # Утренний диалог (5:30)
-    if current_hour == WAKEUP_HOUR and current_minute == WAKEUP_MINUTE:
+    if "wakeup" in due:
         if not data.get("morning_done"):
             # Принудительно закрываем вечерний флаг если остался с ночи
             if data.get("waiting_for_keeper"):
@@ -757,13 +1991,9 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
             save_data(data)
     
     # ВЕЧЕРНИЙ ЧЕК ХРАНИТЕЛЯ (21:00) - ВСТАВЛЯЙ СЮДА
-    if current_hour == 21 and current_minute == 0:
+    if "keeper_check" in due:
         if not data.get("waiting_for_keeper"):
-            # Определяем роль по дате
-            if now.month > 3 or (now.month == 3 and now.day >= 15):
-                role_name = "Старший стоянки"
-            else:
-                role_name = "Хранитель соглашений"
+            role_name = ROLE_NAMES[plan.role]
             
             await context.bot.send_message(
                 chat_id=user_id,
@@ -775,7 +2005,7 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
     # ============== НАПОМИНАЛКИ РОЛЕЙ ==============
 
     # 04:00 Пн–Пт — Супергерой
-    if current_hour == 4 and current_minute == 0 and current_weekday < 5:
+    if "superhero" in due:
         data["superhero_morning_flag"] = False
         save_data(data)
         await context.bot.send_message(
@@ -784,21 +2014,21 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
         )
 
     # 09:00 Пн–Пт — Дневная смена
-    if current_hour == 9 and current_minute == 0 and current_weekday < 5:
+    if "day_shift" in due:
         await context.bot.send_message(
             chat_id=user_id,
             text="⚒️ Дневная смена племени. Сейчас главное — ремесло, добыча, порядок в лагере. Делай рабочие дела крепко и спокойно. Если будет окно — можно на пару минут открыть мешок Мультимиллионера: цифры, идея, деньги, стратегия."
         )
 
     # 18:00 Пн–Пт — Добрый Папа
-    if current_hour == 18 and current_minute == 0 and current_weekday < 5:
+    if "good_papa" in due:
         await context.bot.send_message(
             chat_id=user_id,
             text="🏕️ Костёр семьи уже горит. Пора возвращаться в лагерь не только телом, но и сердцем. Сегодня роль — Добрый Папа: тепло, внимание, дом, разговор, забота. Не нужен идеал. Нужно одно живое доброе действие."
         )
 
     # 21:30 Пн–Пт — Мультимиллионер или добивка Супергероя (21:00 занят чеком Хранителя)
-    if current_hour == 21 and current_minute == 30 and current_weekday < 5:
+    if "night_workshop" in due:
         if data.get("superhero_morning_flag"):
             msg = ("🔥 Ночная мастерская открыта. Если есть искра — выходит Мультимиллионер. "
                    "Один денежный шаг: идея, таблица, план, контроль, стратегия. "
@@ -810,30 +2040,30 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=user_id, text=msg)
 
     # 08:00 Суббота — Супергерой
-    if current_hour == 8 and current_minute == 0 and current_weekday == 5:
+    if "saturday_hero" in due:
         await context.bot.send_message(
             chat_id=user_id,
             text="📜 День большой охоты. Сегодня племя ждёт от тебя не суеты, а глубокого прохода в пещеры знания. Суббота — день Супергероя. Не обязательно тащить весь мамонт целиком. Но нужно сделать настоящий заход: текст, таблица, правка, источники. Сегодня ты добываешь не мясо, а будущее имя."
         )
 
     # 09:00 Воскресенье — Мультимиллионер
-    if current_hour == 9 and current_minute == 0 and current_weekday == 6:
+    if "sunday_money" in due:
         await context.bot.send_message(
             chat_id=user_id,
             text="💰 Утро Мультимиллионера. Один денежный шаг сегодня важнее десяти фантазий."
         )
 
     # 15:00 Воскресенье — Добрый Папа
-    if current_hour == 15 and current_minute == 0 and current_weekday == 6:
+    if "sunday_family" in due:
         await context.bot.send_message(
             chat_id=user_id,
             text="🌿 Воскресный очаг зовёт. После обеда главное — семья, тепло и присутствие."
         )
     
-    # Проверка голода (бунт каждые 30 мин при >24ч)
+    # Проверка голода (бунт каждые 30 мин при >24ч; «тупятся» — при любом срабатывании)
     mode = get_hunger_mode(data)
     
-    if mode == "riot" and current_minute in [0, 30]:
+    if mode == "riot" and "hunger" in due:
         riots = [
             "🔥 БУНТ! Охотники без оружия уже 24 часа!",
             "🔥 Племя теряет терпение! Где новые орудия?!",
@@ -850,11 +2080,11 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
         )
     
     # Дофамин в :55
-    if current_minute == 55 and DOPAMINE_START_HOUR <= current_hour <= DOPAMINE_END_HOUR and current_hour % 2 != 0:
-        if data.get("last_dopamine_hour") != current_hour:
-            data["last_dopamine_hour"] = current_hour
+    if "dopamine" in due:
+        if data.get("last_dopamine_hour") != now.hour:
+            data["last_dopamine_hour"] = now.hour
             save_data(data)
-            reward_text = get_dopamine_reward()
+            reward_text = get_dopamine_reward(user_id)
             await context.bot.send_message(chat_id=user_id, text=reward_text)
             # Отправляем случайную полную заповедь
             commandments = load_commandments()
@@ -866,11 +2096,11 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
                 )
     
     # Вечер (23:00) — только если режим good
-    if current_hour == 23 and current_minute == 0 and not data.get("goodnight_sent"):
+    if "goodnight" in due and not data.get("goodnight_sent"):
         if mode == "good":
             data["goodnight_sent"] = True
             save_data(data)
-            img = await gigachat.generate_image(get_night_prompt())
+            img = await get_image(get_night_prompt(), "goodnight", user_id)
             if img:
                 await context.bot.send_photo(
                     chat_id=user_id,
@@ -881,7 +2111,7 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
                 await context.bot.send_message(chat_id=user_id, text="🌙 Спокойной ночи, Делатель.")
     
     # Понедельник 8:00 — отчёт за неделю
-    if current_weekday == 0 and current_hour == REPORT_HOUR and current_minute == REPORT_MINUTE:
+    if "weekly_report" in due:
         week_tools = data["arsenal"]["current_week_tools"]
         count = len(week_tools)
         
@@ -896,28 +2126,26 @@ async def main_timer(context: ContextTypes.DEFAULT_TYPE):
                                    (" (ритуальное)" if t.get('ritual') else "")
                                    for t in week_tools[-10:]])  # последние 10
             
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"📊 ОТЧЁТ НЕДЕЛИ\nСоздано орудий: {count}\n\n{tools_list}"
-            )
+            report = f"📊 ОТЧЁТ НЕДЕЛИ\nСоздано орудий: {count}\n\n{tools_list}"
+            album = AlbumBatch()
             
-            # Если 7+ — коллекция
+            # Если 7+ — коллаж из настоящих картинок недели (без новой генерации)
             if count >= 7:
-                collage = await gigachat.generate_image(
-                    "Мезолитическая мастерская, 7 кремнёвых орудий лежат на шкуре бизона "
-                    "в ряд: ножи, наконечники стрел, топор. Зима, снег, костер. "
-                    "Коллекция мастера, реалистичный стиль."
-                )
+                items = get_week_images(week_tools)
+                collage = await make_week_collage(items) if items else None
                 if collage:
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=BytesIO(collage),
-                        caption="🏆 Полный арсенал недели! Великолепная работа."
-                    )
+                    album.add(collage)
+                elif items:
+                    album = load_album(items)
+                if album.items:
+                    report += "\n\n🏆 Полный арсенал недели! Великолепная работа."
+            
+            # Список и коллаж — одним сообщением
+            await album.send(context.bot, user_id, text=report)
         
         # Сброс недели
         data["arsenal"]["current_week_tools"] = []
-        data["arsenal"]["week_start"] = today_str()
+        data["arsenal"]["week_start"] = today_str(data)
         save_data(data)
 
 # ============== ОБРАБОТКА ТЕКСТА ==============
@@ -939,12 +2167,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             data["waiting_for_keeper"] = False
             save_data(data)
             
-            # Генерируем текст через AI
-            now = now_msk()
-            is_elder = (now.month > 3 or (now.month == 3 and now.day >= 15))
-            success_text = await generate_keeper_success_text(data["keeper_streak"], is_elder)
-            
-            await update.message.reply_text(f"✅ Зафиксировано.\n\n{success_text}\n🔥 Серия: {data['keeper_streak']} дней")
+            # Заглушка сразу, текст AI дописывается в неё по мере генерации
+            is_elder = current_plan(data).role == "elder"
+            placeholder = await update.message.reply_text("✅ Зафиксировано.\n\n⏳ …")
+            await stream_keeper_success(placeholder, data["keeper_streak"], is_elder, update.effective_user.id)
             return
             
         elif text_clean in ["сорвал", "no", "не выполнено"]:
@@ -976,30 +2202,202 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif "неудач" in text or "плохо" in text:
         await cmd_penalty(update, context)
 
+# ============== СНИМОК ДЛЯ ТЁПЛОГО РЕСТАРТА ==============
+def save_runtime_snapshot():
+    """Токен, индекс кэша картинок, журнал сработавших событий, память наград"""
+    snapshot = {
+        "saved_at": now_msk().timestamp(),
+        "token": gigachat.token_cache,
+        "image_cache": image_cache_index,
+        "fired": {str(user_id): events for user_id, events in scheduler.fired.items()},
+        "dopamine": {
+            "seed": dopamine.seed,
+            "users": {
+                str(user_id): {"recent": list(dopamine.recent.get(user_id, [])), "rng": rng.getstate()}
+                for user_id, rng in dopamine.rngs.items() if isinstance(user_id, int)
+            }
+        }
+    }
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    file_path = DATA_DIR / RUNTIME_SNAPSHOT_FILE
+    tmp_path = file_path.with_suffix(".json.tmp")
+    try:
+        # В снимке токен GigaChat — файл доступен только владельцу
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # на случай оставшегося от прошлых версий .tmp
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, file_path)
+    except OSError as e:
+        logger.error("Runtime snapshot save error: %s", e)
+
+def restore_runtime_snapshot():
+    """Восстанавливает снимок; без него — холодный старт (индекс кэша с диска)"""
+    file_path = DATA_DIR / RUNTIME_SNAPSHOT_FILE
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        rebuild_image_cache_index()
+        return False
+    except (OSError, ValueError) as e:
+        logger.error("Runtime snapshot load error: %s", e)
+        rebuild_image_cache_index()
+        return False
+    
+    try:
+        token = snapshot.get("token") or {}
+        if token.get("token") and token.get("expires") and now_msk().timestamp() < token["expires"] - 60:
+            gigachat.token_cache = token
+        
+        image_cache_index.clear()
+        image_cache_index.update(snapshot.get("image_cache") or {})
+        
+        for user_id, events in (snapshot.get("fired") or {}).items():
+            scheduler.fired[int(user_id)] = events
+        
+        rewards = snapshot.get("dopamine") or {}
+        if dopamine.seed is None:
+            dopamine.seed = rewards.get("seed")
+        for user_id, state in (rewards.get("users") or {}).items():
+            user_id = int(user_id)
+            version, internal, gauss = state["rng"]
+            dopamine.rng_for(user_id).setstate((version, tuple(internal), gauss))
+            dopamine.recent[user_id] = deque(state["recent"], maxlen=dopamine.recent_size)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        # Битый снимок не должен мешать запуску: забываем восстановленное и стартуем холодно
+        logger.error("Runtime snapshot restore error: %r", e)
+        gigachat.token_cache = {"token": None, "expires": None}
+        scheduler.fired.clear()
+        dopamine.rngs.clear()
+        dopamine.recent.clear()
+        rebuild_image_cache_index()
+        return False
+    
+    logger.info("Runtime snapshot restored", extra={"handler": "restore_runtime_snapshot"})
+    return True
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    save_runtime_snapshot()
+    log_handler.report_dropped()
+
+# ============== ЗАПУСК ==============
+async def warm_up(app):
+    """post_init: всё дорогое — до первого апдейта (кэши, пул процессов, токен, TLS)"""
+    started = time.perf_counter()
+    restore_runtime_snapshot()
+    load_commandments()
+    load_campaigns()
+    data = load_data()
+    if data.get("user_id"):
+        scheduler.sync_user(data["user_id"], data)
+    
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        # Зависший GigaChat не должен задерживать старт: не успели — прогреется на первом запросе
+        asyncio.wait_for(gigachat.warm_up(), GIGACHAT_WARM_UP_TIMEOUT),
+        *[loop.run_in_executor(get_process_pool(), warm_worker) for _ in range(IMAGE_WORKERS)],
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Warm-up step failed: %r", result, extra={"handler": "warm_up"})
+    logger.info("Warm-up done", extra={
+        "handler": "warm_up",
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+    })
+
+async def flush_pending(app):
+    """post_stop: склеенные, но ещё не обработанные повторы не теряются при рестарте"""
+    await ingress.flush_all(app)
+
+async def close_connections(app):
+    """post_shutdown: сохранить снимок и закрыть пул соединений GigaChat"""
+    save_runtime_snapshot()
+    await gigachat.close()
+
+# ============== ВЫБОР ЛИДЕРА ==============
+def try_acquire_leadership():
+    """Эксклюзивная блокировка файла; None — лидер уже есть.
+    ОС снимает блокировку сама, если процесс-лидер умер."""
+    lock_file = open(DATA_DIR / LEADER_LOCK_FILE, "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    return lock_file
+
+def wait_for_leadership():
+    """Ждёт в резерве, пока текущий лидер не завершится (например, при деплое)"""
+    lock_file = try_acquire_leadership()
+    if lock_file is None:
+        logger.info("Другой процесс уже лидер — жду в резерве")
+    while lock_file is None:
+        time.sleep(LEADER_RETRY_SECONDS)
+        lock_file = try_acquire_leadership()
+    logger.info("Процесс %s стал лидером", os.getpid())
+    return lock_file
+
 # ============== MAIN ==============
 def main():
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     
+    # python bot.py export|import <файл.ndjson[.zst]>
+    if len(sys.argv) == 3 and sys.argv[1] == "export":
+        print(f"Записей: {export_state(sys.argv[2])}")
+        return
+    if len(sys.argv) == 3 and sys.argv[1] == "import":
+        # Работающий бот перезапишет импортированное состояние — держим его блокировку сами
+        lock_file = try_acquire_leadership()
+        if lock_file is None:
+            sys.exit("Бот запущен (блокировка лидера занята) — остановите его перед импортом")
+        try:
+            print(f"Импортировано: {dict(import_state(sys.argv[2]))}")
+        finally:
+            lock_file.close()
+        return
+    
     if not BOT_TOKEN:
         logger.error("No BOT_TOKEN!")
         return
     
-    app = Application.builder().token(BOT_TOKEN).build()
+    # Второй экземпляр не должен дублировать напоминания и делить getUpdates
+    leader_lock = wait_for_leadership()
+    
+    app = (Application.builder().token(BOT_TOKEN)
+           .post_init(warm_up)
+           .post_stop(flush_pending)
+           .post_shutdown(close_connections)
+           .build())
     
     # Хендлеры
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("done", cmd_done))
-    app.add_handler(CommandHandler("tried", cmd_tried))
-    app.add_handler(CommandHandler("penalty", cmd_penalty))
-    app.add_handler(CommandHandler("penalty20", cmd_penalty20))
-    app.add_handler(CommandHandler("status", cmd_status))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(CommandHandler("start", timed_handler(cmd_start)))
+    app.add_handler(CommandHandler("done", timed_handler(cmd_done)))
+    app.add_handler(CommandHandler("tried", timed_handler(cmd_tried)))
+    app.add_handler(CommandHandler("penalty", timed_handler(cmd_penalty)))
+    app.add_handler(CommandHandler("penalty20", timed_handler(cmd_penalty20)))
+    app.add_handler(CommandHandler("status", timed_handler(cmd_status)))
+    app.add_handler(CommandHandler("tz", timed_handler(cmd_tz)))
+    app.add_handler(CommandHandler("schedule", timed_handler(cmd_schedule)))
+    app.add_handler(CommandHandler("export", timed_handler(cmd_export)))
+    app.add_handler(CommandHandler("usage", timed_handler(cmd_usage)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(handle_text)))
     
-    # Таймер каждую минуту
-    app.job_queue.run_repeating(main_timer, interval=60, first=10)
+    # Таймер просыпается только к ближайшему событию из расписания
+    app.job_queue.run_once(scheduler_job, when=10, name="scheduler")
+    app.job_queue.run_repeating(snapshot_job, interval=RUNTIME_SNAPSHOT_INTERVAL, first=RUNTIME_SNAPSHOT_INTERVAL)
     
     logger.info("Делатель орудий v5.21 запущен")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
+    
+    if _process_pool:
+        _process_pool.shutdown()
+    leader_lock.close()
 
 if __name__ == "__main__":
     main()
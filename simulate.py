@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Симуляция всей кампании (17 января — 11 апреля) за секунды.
+
+Часы бота подменяются на SimClock, Telegram и GigaChat — на заглушки.
+Каждую симулированную минуту вызывается main_timer, а скриптовый
+пользователь отвечает на утренний и вечерний вопросы и делает орудия.
+
+    python simulate.py --seed 7 --timeline timeline.txt
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+
+import bot
+
+# ============== ЗАГЛУШКИ ==============
+def make_stub_image(color):
+    from PIL import Image
+    buf = BytesIO()
+    Image.new("RGB", (64, 64), color).save(buf, "JPEG")
+    return buf.getvalue()
+
+class StubGigaChat:
+    """GigaChat без сети: токена нет, картинки — маленькие однотонные JPEG"""
+
+    def __init__(self):
+        self.images = 0
+
+    async def get_token(self):
+        return None
+
+    async def generate_image(self, prompt, **kwargs):
+        self.images += 1
+        return make_stub_image((self.images * 37 % 256, 90, 60))
+
+class StubBot:
+    """Telegram-бот, который пишет всё отправленное в ленту событий"""
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.sent = Counter()
+
+    def _log(self, kind, text):
+        self.sent[kind] += 1
+        first_line = (text or "").split("\n")[0]
+        self.timeline.append(f"{bot.now_msk():%Y-%m-%d %a %H:%M} → {kind}: {first_line}")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._log("message", text)
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self._log("photo", caption)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self._log("album", media[0].caption)
+
+class StubMessage:
+    def __init__(self, stub_bot, text):
+        self.bot = stub_bot
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        await self.bot.send_message(chat_id=USER_ID, text=text)
+        return StubMessage(self.bot, text)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        self.bot._log("edit", text)
+
+USER_ID = 1
+
+def make_update(stub_bot, text):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=USER_ID),
+        message=StubMessage(stub_bot, text)
+    )
+
+# ============== СКРИПТ ПОЛЬЗОВАТЕЛЯ ==============
+class ScriptedUser:
+    """Поведение пользователя: когда отвечает и сколько орудий делает за день"""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.day = None
+        self.tool_minutes = set()
+
+    def plan_day(self, now):
+        self.day = now.date()
+        # 0–4 орудия в день, между 10:00 и 20:00
+        count = self.rng.choice([0, 1, 1, 2, 2, 2, 3, 4])
+        self.tool_minutes = {self.rng.randint(10 * 60, 20 * 60) for _ in range(count)}
+
+    def actions(self, now, data):
+        """Список текстов, которые пользователь отправит в эту минуту"""
+        if now.date() != self.day:
+            self.plan_day(now)
+        minute_of_day = now.hour * 60 + now.minute
+        texts = []
+        if data.get("waiting_for_plans") and minute_of_day == 5 * 60 + 45:
+            texts.append("есть" if self.rng.random() < 0.7 else "нет")
+        if data.get("waiting_for_keeper") and minute_of_day == 21 * 60 + 10:
+            texts.append("сдержал" if self.rng.random() < 0.8 else "сорвал")
+        if minute_of_day in self.tool_minutes:
+            texts.append("сделал")
+        if minute_of_day == 14 * 60 and self.rng.random() < 0.2:
+            texts.append("попробовал")
+        if minute_of_day == 16 * 60 and self.rng.random() < 0.05:
+            texts.append("неудача")
+        return texts
+
+# ============== ПРОГОН ==============
+async def run(days, seed, timeline_path):
+    random.seed(seed)
+    rng = random.Random(seed)
+
+    data_dir = Path(tempfile.mkdtemp(prefix="stoyanka_sim_"))
+    bot.DATA_DIR = data_dir
+    bot.IMAGES_DIR = data_dir / "images"
+    bot.IMAGE_CACHE_DIR = data_dir / "image_cache"
+
+    campaign = bot.get_campaign()
+    sim_clock = bot.SimClock(campaign.start)
+    bot.set_clock(sim_clock)
+    bot.gigachat = StubGigaChat()
+    bot.dopamine.seed = seed
+
+    writes = Counter()
+    original_save = bot.save_data
+    def counting_save(data):
+        writes["state"] += 1
+        original_save(data)
+    bot.save_data = counting_save
+
+    timeline = []
+    stub_bot = StubBot(timeline)
+    context = SimpleNamespace(bot=stub_bot)
+    user = ScriptedUser(rng)
+
+    await bot.cmd_start(make_update(stub_bot, "/start"), context)
+
+    end = campaign.end
+    if days:
+        end = min(end, sim_clock.now() + timedelta(days=days))
+
+    ticks = 0
+    started = time.perf_counter()
+    while sim_clock.now() < end:
+        await bot.main_timer(context)
+        for text in user.actions(sim_clock.now(), bot.load_data()):
+            timeline.append(f"{sim_clock.now():%Y-%m-%d %a %H:%M} ← {text}")
+            await bot.handle_text(make_update(stub_bot, text), context)
+        ticks += 1
+        sim_clock.advance()
+    elapsed = time.perf_counter() - started
+
+    if bot._process_pool:
+        bot._process_pool.shutdown()
+
+    data = bot.load_data()
+    if timeline_path:
+        Path(timeline_path).write_text("\n".join(timeline) + "\n", encoding="utf-8")
+
+    print(f"Симулировано минут: {ticks} ({ticks / 1440:.1f} дн.) за {elapsed:.2f} с")
+    print(f"Тиков в секунду: {ticks / elapsed:.0f}")
+    print(f"Записей состояния: {writes['state']}")
+    print("Отправлено: " + ", ".join(f"{k}={v}" for k, v in sorted(stub_bot.sent.items())))
+    print(f"Картинок сгенерировано: {bot.gigachat.images}")
+    print(f"Орудий создано: {data['arsenal']['total_created']}/{campaign.target}, "
+          f"серия Хранителя: {data.get('keeper_streak', 0)}")
+    print(f"Данные: {data_dir}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Симуляция кампании Делателя орудий")
+    parser.add_argument("--days", type=int, default=0, help="ограничить число дней (0 — вся кампания)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeline", help="файл для ленты событий")
+    args = parser.parse_args()
+    asyncio.run(run(args.days, args.seed, args.timeline))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Склейка повторов /done и очерёдность пачек орудий одного пользователя"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self.sent.append(caption)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.sent.append(media[0].caption)
+
+
+class FakeJobQueue:
+    """Задачи не запускаются сами — тест вызывает их вручную"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        self.jobs.append(SimpleNamespace(callback=callback, data=data))
+
+    async def run_next(self, context):
+        job = self.jobs.pop(0)
+        await job.callback(SimpleNamespace(bot=context.bot, job=job, job_queue=self))
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(bot, "IMAGES_DIR", tmp_path / "images")
+
+    async def slow_image(prompt, purpose, user_id=None):
+        # Долгая генерация: за это время успевает начаться другая пачка
+        await asyncio.sleep(0.05)
+        return None
+    monkeypatch.setattr(bot, "get_image", slow_image)
+
+    data = bot.load_data()
+    data["user_id"] = 1
+    bot.save_data(data)
+
+
+def test_concurrent_batches_do_not_lose_tools():
+    context = SimpleNamespace(bot=FakeBot())
+
+    async def run():
+        await asyncio.gather(bot.create_tools(context, 1, 2), bot.create_tools(context, 1, 1))
+    asyncio.run(run())
+
+    data = bot.load_data()
+    assert data["arsenal"]["total_created"] == 3
+    assert len(data["arsenal"]["current_week_tools"]) == 3
+
+
+def test_repeats_queued_behind_slow_run_are_merged():
+    limiter = bot.IngressLimiter(bot.load_ingress_policy())
+    job_queue = FakeJobQueue()
+    context = SimpleNamespace(bot=FakeBot(), job_queue=job_queue)
+    calls = []
+
+    async def callback(ctx, user_id, count):
+        calls.append(count)
+        await bot.create_tools(ctx, user_id, count)
+
+    async def run():
+        # Первое сообщение — сразу; два повтора приходят, пока оно ещё обрабатывается
+        first = asyncio.create_task(limiter.debounce(1, "tools", context, callback))
+        await asyncio.sleep(0.01)
+        await limiter.debounce(1, "tools", context, callback)
+        await first
+        # Апдейты идут по одному: этот повтор ждал в очереди за долгой генерацией
+        await limiter.debounce(1, "tools", context, callback)
+        assert calls == [1]
+        # Окно закрылось: оба повтора — одной пачкой, окно открывается снова
+        await job_queue.run_next(context)
+        assert calls == [1, 2]
+        # Повторов больше не было — окно закрывается без вызова
+        await job_queue.run_next(context)
+        assert not job_queue.jobs
+    asyncio.run(run())
+
+    assert calls == [1, 2]
+    assert bot.load_data()["arsenal"]["total_created"] == 3
+    assert (1, "tools") not in limiter.pending
+
+
+def test_tools_burst_bounds_rapid_repeats():
+    limiter = bot.IngressLimiter(bot.load_ingress_policy())
+    allowed = [limiter.allow(1, "tools") for _ in range(5)]
+    assert allowed.count(True) == bot.INGRESS_POLICY["tools"]["burst"] < 5
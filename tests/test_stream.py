@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Потоковый ответ Хранителя против локальной SSE-заглушки GigaChat"""
+
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from telegram.error import TimedOut
+
+import bot
+
+
+class FakeMessage:
+    """Сообщение-заглушка: запоминает все правки"""
+
+    def __init__(self, fail_first=0):
+        self.edits = []
+        self.fail_first = fail_first
+
+    async def edit_text(self, text):
+        if self.fail_first:
+            self.fail_first -= 1
+            raise TimedOut()
+        self.edits.append(text)
+
+
+def sse_app(chunks, delay=0.0, done=True, tail=()):
+    """SSE-ответ /chat/completions: chunks, затем [DONE], затем tail (должен игнорироваться)"""
+    async def completions(request):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for chunk in chunks:
+            payload = {"choices": [{"delta": {"content": chunk}}]}
+            await resp.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            await asyncio.sleep(delay)
+        if done:
+            await resp.write(b"data: [DONE]\n\n")
+        for chunk in tail:
+            payload = {"choices": [{"delta": {"content": chunk}}]}
+            await resp.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", completions)
+    return app
+
+
+async def run_with_stub(app, monkeypatch, message, streak=3):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(bot, "GIGACHAT_API_URL", f"http://127.0.0.1:{port}")
+    try:
+        return await bot.stream_keeper_success(message, streak, is_elder=False, user_id=1)
+    finally:
+        await bot.gigachat.close()
+        await runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(bot, "usage", bot.UsageAccountant())
+    monkeypatch.setattr(bot, "gigachat", bot.GigaChatAPI())
+
+    async def fake_token():
+        return "test-token"
+    monkeypatch.setattr(bot.gigachat, "get_token", fake_token)
+
+
+def test_streamed_text_and_done(monkeypatch):
+    message = FakeMessage()
+    app = sse_app(["Слово ", "сдержано. ", "Племя спокойно."], tail=["после DONE"])
+    text = asyncio.run(run_with_stub(app, monkeypatch, message))
+
+    assert text == "Слово сдержано. Племя спокойно."
+    assert message.edits[-1] == "✅ Зафиксировано.\n\nСлово сдержано. Племя спокойно.\n🔥 Серия: 3 дней"
+    assert all("после DONE" not in edit for edit in message.edits)
+
+
+def test_intermediate_edits_are_throttled(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.2)
+    message = FakeMessage()
+    app = sse_app([f"{i} " for i in range(10)], delay=0.05)
+    asyncio.run(run_with_stub(app, monkeypatch, message))
+
+    intermediate = [edit for edit in message.edits if edit.endswith(" …")]
+    # ~0.5 с потока при интервале 0.2 с: несколько правок, но не по одной на кусочек
+    assert 1 <= len(intermediate) <= 4
+    assert message.edits[-1].endswith("🔥 Серия: 3 дней")
+
+
+def test_empty_stream_falls_back(monkeypatch):
+    message = FakeMessage()
+    text = asyncio.run(run_with_stub(sse_app([]), monkeypatch, message))
+
+    assert text == "Договоренность удержана. Племя спокойно."
+    assert message.edits == [f"✅ Зафиксировано.\n\n{text}\n🔥 Серия: 3 дней"]
+
+
+def test_no_token_falls_back(monkeypatch):
+    async def no_token():
+        return None
+    monkeypatch.setattr(bot.gigachat, "get_token", no_token)
+    message = FakeMessage()
+    text = asyncio.run(bot.stream_keeper_success(message, 1, is_elder=True))
+
+    assert text == "Слово сдержано. Порядок восстановлен."
+    assert message.edits[-1].startswith("✅ Зафиксировано.\n\nСлово сдержано.")
+
+
+def test_edit_errors_do_not_stick_placeholder(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0)
+    # Первая промежуточная правка падает по таймауту — поток продолжается, финал доходит
+    message = FakeMessage(fail_first=1)
+    text = asyncio.run(run_with_stub(sse_app(["Слово ", "сдержано."]), monkeypatch, message))
+
+    assert text == "Слово сдержано."
+    assert message.edits[-1].endswith("🔥 Серия: 3 дней")
+
+
+def test_failed_stream_is_counted_in_usage(monkeypatch):
+    async def unavailable(request):
+        return web.Response(status=503)
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", unavailable)
+    message = FakeMessage()
+    text = asyncio.run(run_with_stub(app, monkeypatch, message))
+
+    assert text == "Договоренность удержана. Племя спокойно."
+    assert bot.usage.load()["daily"]["purposes"]["keeper"]["calls"] == 1